@@ -229,4 +229,32 @@ def enlarge_edge(poly, r, accuracy=3):
             end2.append((points[-1] + e2.rotate(-RIGHT_ANGLE*2*i/num)*-1).tuple())
     newpoints = end1 + side1 + end2 + side2
     # Smoosh those two together
-    return Polygon(newpoints)
\ No newline at end of file
+    return Polygon(newpoints)
+
+
+######################################################## Grid meshing ##########
+
+
+def greedy_rectangles(squares):
+    """
+    Covers a set of (x, y) grid squares with a few disjoint rectangles,
+    returned as (x1, y1, x2, y2) with x2 and y2 exclusive. Greedy: take the
+    lowest remaining square, run it as far along x as it goes, then grow
+    that run along y while every square of the next row is there too.
+    """
+    remaining = set(squares)
+    rects = []
+    for x, y in sorted(remaining, key=lambda (x, y): (y, x)):
+        if (x, y) not in remaining:
+            continue
+        x2 = x + 1
+        while (x2, y) in remaining:
+            x2 += 1
+        y2 = y + 1
+        while all((ix, y2) in remaining for ix in range(x, x2)):
+            y2 += 1
+        for iy in range(y, y2):
+            for ix in range(x, x2):
+                remaining.discard((ix, iy))
+        rects.append((x, y, x2, y2))
+    return rects
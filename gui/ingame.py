@@ -3,9 +3,17 @@
 In-game controller and functions.
 """
 
+import Queue
+from collections import OrderedDict
+
+import numpy
+
 from gui import BaseController
 from world import build_test_world
-from geometry import enlarge_polygon, enlarge_edge
+from world.constants import NORTH, EAST, SOUTH, WEST
+from sim import Simulation
+from sim.threaded import SimulationThread
+from geometry import enlarge_polygon, enlarge_edge, greedy_rectangles
 
 from pandac.PandaModules import *
 import direct.directbase.DirectStart
@@ -21,14 +29,121 @@ def exampleTask(task):
     return Task.done
 
 
-def make_vertex_data(name="data"):
-    "Creates a GeomVertexData and writers, ready for input"
-    format = GeomVertexFormat.getV3c4t2()
-    vdata = GeomVertexData(name, format, Geom.UHStatic)
-    vertex = GeomVertexWriter(vdata, 'vertex')
-    color = GeomVertexWriter(vdata, 'color')
-    texcoord = GeomVertexWriter(vdata, 'texcoord')
-    return vdata, vertex, color, texcoord
+# Vertex rows are interleaved float32 position, colour and texture coords;
+# VERTEX_DTYPE is the NumPy mirror of vertex_format().
+VERTEX_DTYPE = numpy.dtype([
+    ("vertex", numpy.float32, 3),
+    ("color", numpy.float32, 4),
+    ("texcoord", numpy.float32, 2),
+])
+_vertex_format = None
+
+
+def vertex_format():
+    "Returns the (registered) GeomVertexFormat matching VERTEX_DTYPE."
+    global _vertex_format
+    if _vertex_format is None:
+        array = GeomVertexArrayFormat()
+        array.addColumn(InternalName.getVertex(), 3, Geom.NTFloat32, Geom.CPoint)
+        array.addColumn(InternalName.getColor(), 4, Geom.NTFloat32, Geom.CColor)
+        array.addColumn(InternalName.getTexcoord(), 2, Geom.NTFloat32, Geom.CTexcoord)
+        _vertex_format = GeomVertexFormat.registerFormat(array)
+    return _vertex_format
+
+
+def strip_triangles(length):
+    """
+    Returns the (length - 2, 3) vertex indices of the triangles in one
+    tristrip of the given length, every other one flipped to keep the
+    winding the same (as Panda does when it decomposes strips).
+    """
+    first = numpy.arange(length - 2, dtype=numpy.uint32)
+    triangles = numpy.column_stack((first, first + 1, first + 2))
+    triangles[1::2, :2] = triangles[1::2, 1::-1]
+    return triangles
+
+
+class MeshBuilder(object):
+    
+    """
+    Collects triangles for one Geom as NumPy arrays, then copies them into
+    Panda's vertex and index buffers in one go (through the buffer
+    protocol), instead of writing every vertex through GeomVertexWriters.
+    """
+    
+    def __init__(self, name="data"):
+        self.name = name
+        self.vertices = []
+        self.indices = []
+        self.count = 0
+    
+    
+    def add_strips(self, strips, color=(1, 1, 1, 1)):
+        """
+        Adds triangle strips, given as an (n, k, 5) array of n strips of k
+        (x, y, z, u, v) points each; they're stored as plain triangles.
+        """
+        strips = numpy.asarray(strips, dtype=numpy.float32)
+        if not strips.size:
+            return
+        n, k = strips.shape[:2]
+        points = strips.reshape(n * k, 5)
+        rows = numpy.empty(n * k, dtype=VERTEX_DTYPE)
+        rows["vertex"] = points[:, :3]
+        rows["color"] = color
+        rows["texcoord"] = points[:, 3:]
+        self.vertices.append(rows)
+        starts = numpy.arange(n, dtype=numpy.uint32) * k + self.count
+        self.indices.append((strip_triangles(k)[None] + starts[:, None, None]).ravel())
+        self.count += n * k
+    
+    
+    def make_geom(self):
+        "Returns a Geom of everything added so far."
+        vdata = GeomVertexData(self.name, vertex_format(), Geom.UHStatic)
+        geom = Geom(vdata)
+        if not self.count:
+            return geom
+        vertices = numpy.concatenate(self.vertices)
+        vdata.uncleanSetNumRows(len(vertices))
+        vdata.modifyArray(0).modifyHandle().copyDataFrom(vertices)
+        prim = GeomTriangles(Geom.UHStatic)
+        prim.setIndexType(Geom.NTUint32)
+        indices = numpy.concatenate(self.indices)
+        index_array = prim.modifyVertices()
+        index_array.uncleanSetNumRows(len(indices))
+        index_array.modifyHandle().copyDataFrom(indices)
+        geom.addPrimitive(prim)
+        return geom
+
+
+def merge_wall_runs(walls):
+    """
+    Takes the unit wall edges made by create_wall and joins each straight,
+    door-free chain of them into one run, keeping the chamfers from its two
+    ends (where edges join in a straight line, neither has one). Doors are
+    left as unit edges of their own.
+    """
+    # Index the plain edges by where they start
+    starts = {}
+    for wall in walls:
+        x, y, x2, y2, z, dx, dy = wall[:7]
+        if not wall[11]:
+            starts[x, y, z, dx, dy] = wall
+    ends = set((wall[2], wall[3], wall[4], wall[5], wall[6]) for wall in starts.values())
+    runs = [wall for wall in walls if wall[11]]
+    for key, wall in starts.items():
+        # Only start from the first edge of each run
+        if key in ends:
+            continue
+        last = wall
+        while True:
+            following = starts.get((last[2], last[3], last[4], last[5], last[6]))
+            if following is None:
+                break
+            last = following
+        runs.append(wall[:2] + last[2:4] + wall[4:9] + last[9:11] + (0,))
+    return runs
 
 
 class InGameController(BaseController):
@@ -37,6 +152,9 @@ class InGameController(BaseController):
     PAN_STEP = 0.01
     PAN_START = 0.003
     ROTATE_SPEED = 80
+    SIM_SPEED = 60 # Game seconds per real second
+    CHUNK_SIZE = 16 # Squares along each side of a scenery chunk
+    REBUILD_BUDGET = 0.004 # Seconds per frame to spend rebuilding chunks
     
     ROOM_TEXTURES = {
         "corridor": ("wall_2.png", "floor_1.png"),
@@ -92,18 +210,46 @@ class InGameController(BaseController):
         
         # Set up game world
         self.create_base()
-        self.create_outer_walls(self.world)
-        for room in self.world.rooms:
-            self.create_room(self.world, room)
-        for item in self.world.items:
-            self.create_item(self.world, item)
+        self.chunks = {}
+        # Only look inside the rooms' allocated grid chunks; create_chunk
+        # skips any scenery chunk in them that turns out to have no rooms
+        for z in self.world.rooms.levels():
+            grid = self.world.rooms.level(z)
+            ratio = grid.SIZE // self.CHUNK_SIZE
+            for gx, gy in grid.chunks():
+                for cx in range(gx * ratio, (gx + 1) * ratio):
+                    for cy in range(gy * ratio, (gy + 1) * ratio):
+                        self.create_chunk(self.world, cx, cy, z)
+        
+        # From now on, edits just mark chunks to be rebuilt a few at a time.
+        # Edits may come from the simulation thread, hence the Queue.
+        self.dirty_chunks = Queue.Queue()
+        self.rebuild_queue = OrderedDict()
+        self.world.rooms.listen(self.mark_dirty)
+        self.world.doors.listen(self.mark_dirty)
+        taskMgr.add(self.rebuild_task, 'RebuildTask')
+        for placement in self.world.items.placements():
+            self.create_item(self.world, placement)
         
         self.create_gui()
         
-        # Add a test Person
+        # Start the simulation off on its own thread, with some test
+        # passengers heading for the lounge
+        self.sim = Simulation(self.world)
+        lounge = self.sim.add_destination("lounge", [
+            (x, y)
+            for room in self.world.rooms
+            if room.type == "lounge"
+            for x, y, z in self.world.rooms.coords_for_item(room)
+        ])
+        self.sim.spawn([(4 + i % 5, 3 + i // 5) for i in range(20)], lounge, wait=5)
+        self.sim_thread = SimulationThread(self.sim, self.SIM_SPEED)
+        self.sim_thread.start()
+        
+        # People get drawn from the simulation's snapshots
         self.people = self.root.attachNewNode("People")
-        person = PersonModel(self.people.attachNewNode("test_person"))
-        person.set_position(3, 2.5, 0)
+        self.person_models = {}
+        taskMgr.add(self.people_task, 'PeopleTask')
     
     
     def get_zoom(self):
@@ -219,7 +365,7 @@ class InGameController(BaseController):
         bold = self.gui.load_font("DroidSans-Bold")
         
         # Add a 'clock'
-        self.clock = OnscreenText(text="May 13  20:14", parent=self.gui.p2dtr, mayChange=True, fg=(1,1,1,1), bg=(0,0,0,0), scale=13, align=TextNode.ARight, font=bold)
+        self.clock = OnscreenText(text="", parent=self.gui.p2dtr, mayChange=True, fg=(1,1,1,1), bg=(0,0,0,0), scale=13, align=TextNode.ARight, font=bold)
         self.clock.setPos(-8, -16)
         self.cleanable.append("clock") 
         
@@ -234,21 +380,73 @@ class InGameController(BaseController):
         #self.bottom_panel.setPos(0, 0, 35)
         #self.room_button = self.gui.load_texture_card(self.bottom_panel, "gui/build_room", 48, 48)
     
+    def people_task(self, task):
+        "Moves the PersonModels (and clock) to where the simulation last said."
+        game_time, positions, indices = self.sim_thread.interpolated()
+        present = set(indices)
+        for index, person in self.person_models.items():
+            if index not in present:
+                person.nodepath.hide()
+        for index in indices:
+            person = self.person_models.get(index)
+            if person is None:
+                person = PersonModel(self.people.attachNewNode("person_%i" % index))
+                self.person_models[index] = person
+            person.nodepath.show()
+            person.set_position(positions[index, 0], positions[index, 1], self.sim.z)
+        self.clock.setText(self.sim.now(game_time).strftime("%b %d  %H:%M"))
+        return Task.cont
+    
+    
+    def mark_dirty(self, x1, y1, x2, y2, z):
+        "Queues the chunks touching a changed region for rebuilding."
+        size = self.CHUNK_SIZE
+        # Walls depend on the squares next door, so look one square further
+        for cx in range((x1 - 1) // size, x2 // size + 1):
+            for cy in range((y1 - 1) // size, y2 // size + 1):
+                self.dirty_chunks.put((cx, cy, z))
+    
+    
+    def rebuild_task(self, task):
+        "Rebuilds dirty chunks, oldest first, until this frame's budget is gone."
+        while True:
+            try:
+                key = self.dirty_chunks.get_nowait()
+            except Queue.Empty:
+                break
+            self.rebuild_queue[key] = True
+        start = globalClock.getRealTime()
+        while self.rebuild_queue:
+            key = self.rebuild_queue.popitem(last=False)[0]
+            old = self.chunks.pop(key, None)
+            if old is not None:
+                old.removeNode()
+            self.create_chunk(self.world, *key)
+            if globalClock.getRealTime() - start > self.REBUILD_BUDGET:
+                break
+        return Task.cont
+    
+    
+    def clean(self):
+        taskMgr.remove('PeopleTask')
+        taskMgr.remove('RebuildTask')
+        self.world.rooms.unlisten(self.mark_dirty)
+        self.world.doors.unlisten(self.mark_dirty)
+        self.sim_thread.stop()
+        self.sim.close()
+        BaseController.clean(self)
+    
+    
     def create_base(self):
         "Creates the base layer (i.e. a rectangle of grass)"
-        # Make the VertexData
-        vdata, vertex, color, texcoord = make_vertex_data("base_layer")
-        for x, y in [(0,0), (self.world.size[0], 0), self.world.size, (0, self.world.size[1])]:
-            vertex.addData3f(x, y, 0)
-            color.addData4f(1, 1, 1, 1)
-            texcoord.addData2f(x/2.0, y/2.0)
-        # Now, make the plane
-        prim = GeomTristrips(Geom.UHStatic)
-        prim.addVertices(0, 1, 3, 2)
-        prim.closePrimitive()
+        # Make the plane
+        builder = MeshBuilder("base_layer")
+        builder.add_strips([[
+            (x, y, 0, x/2.0, y/2.0)
+            for x, y in [(0,0), (self.world.size[0], 0), (0, self.world.size[1]), self.world.size]
+        ]])
         # And add it to the scene
-        geom = Geom(vdata)
-        geom.addPrimitive(prim)
+        geom = builder.make_geom()
         node = GeomNode('base_layer')
         node.addGeom(geom)
         tex = loader.loadTexture('textures/grass.png', minfilter=Texture.FTLinearMipmapLinear)
@@ -256,29 +454,36 @@ class InGameController(BaseController):
         node_path.setTexture(tex)
     
     
-    def create_wall(self, item, locdict, doordict, inside=False, w=0.025, h=1):
-        "Creates a wall along the boundar[y,ies] of the given item in the given locdict"
-        # Set up the two drawing constructs
-        vdata, vertex, color, texcoord = make_vertex_data("base_layer")
-        prim = GeomTristrips(Geom.UHStatic)
-        doors = set()
-        draw_walls = [] # Two 2D points for the wall, one 2D vector for the width, one for the taper either end.
+    def create_wall(self, item, locdict, doordict, inside=False, w=0.025, h=1, coords=None):
+        """
+        Creates a wall along the boundar[y,ies] of the given item in the given
+        locdict. Pass coords to only do the walls of some of its squares.
+        """
+        # Every wall (and door piece) is a six-point strip
+        strips = []
+        draw_walls = [] # Two 2D points for the wall, one 2D vector for the width, one for the taper either end, door flag.
         # Outside walls don't have a particular item
         if inside:
-            coords = locdict.coords_for_item(item)
+            if coords is None:
+                coords = locdict.coords_for_item(item)
             test = lambda x: x is item
         else:
-            coords = item
+            if coords is None:
+                coords = item
             test = lambda x: x is not None
         # Loop through each coord...
         for x, y, z in coords:
+            # Find which sides have doors in them
+            door_sides = doordict.open_sides(x, y, z)
+            # Fetch the 3x3 neighbourhood once
+            sw, west, nw = [test(locdict.get(x-1, y+i, z)) for i in (-1, 0, 1)]
+            se, east, ne = [test(locdict.get(x+1, y+i, z)) for i in (-1, 0, 1)]
+            south = test(locdict.get(x, y-1, z))
+            north = test(locdict.get(x, y+1, z))
             # Test to see which sides of this coord are exposed.
-            if not test(locdict.get(x-1, y, z)):
+            if not west:
                 # Determine what kind of corners either end has
-                c1 = not test(locdict.get(x, y-1, z))
-                c2 = not test(locdict.get(x, y+1, z))
-                ic1 = test(locdict.get(x-1, y-1, z))
-                ic2 = test(locdict.get(x-1, y+1, z))
+                c1, c2, ic1, ic2 = not south, not north, sw, nw
                 # Correctly swap if we're doing an inside wall
                 if inside:
                     wall = (x, y+1, x, y, z, w, 0)
@@ -287,13 +492,10 @@ class InGameController(BaseController):
                     wall = (x, y, x, y+1, z, -w, 0)
                 # Work out what kind of chamfer is needed
                 chamfer = (0, -w if c1 else w if ic1 else 0, 0, w if c2 else -w if ic2 else 0)
-                draw_walls.append(wall + chamfer)
-            if not test(locdict.get(x+1, y, z)):
+                draw_walls.append(wall + chamfer + (door_sides & WEST,))
+            if not east:
                 # Determine what kind of corners either end has
-                c1 = not test(locdict.get(x, y+1, z))
-                c2 = not test(locdict.get(x, y-1, z))
-                ic1 = test(locdict.get(x+1, y+1, z))
-                ic2 = test(locdict.get(x+1, y-1, z))
+                c1, c2, ic1, ic2 = not north, not south, ne, se
                 # Correctly swap if we're doing an inside wall
                 if inside:
                     wall = (x+1, y, x+1, y+1, z, -w, 0)
@@ -302,13 +504,10 @@ class InGameController(BaseController):
                     wall = (x+1, y+1, x+1, y, z, w, 0)
                 # Work out what kind of chamfer is needed
                 chamfer = (0, w if c1 else -w if ic1 else 0, 0, -w if c2 else w if ic2 else 0)
-                draw_walls.append(wall + chamfer)
-            if not test(locdict.get(x, y-1, z)):
+                draw_walls.append(wall + chamfer + (door_sides & EAST,))
+            if not south:
                 # Determine what kind of corners either end has
-                c1 = not test(locdict.get(x+1, y, z))
-                c2 = not test(locdict.get(x-1, y, z))
-                ic1 = test(locdict.get(x+1, y-1, z))
-                ic2 =  test(locdict.get(x-1, y-1, z))
+                c1, c2, ic1, ic2 = not east, not west, se, sw
                 # Correctly swap if we're doing an inside wall
                 if inside:
                     wall = (x, y, x+1, y, z, 0, w)
@@ -317,13 +516,10 @@ class InGameController(BaseController):
                     wall = (x+1, y, x, y, z, 0, -w)
                 # Work out what kind of chamfer is needed
                 chamfer = (w if c1 else -w if ic1 else 0, 0, -w if c2 else w if ic2 else 0, 0)
-                draw_walls.append(wall + chamfer)
-            if not test(locdict.get(x, y+1, z)):
+                draw_walls.append(wall + chamfer + (door_sides & SOUTH,))
+            if not north:
                 # Determine what kind of corners either end has
-                c1 = not test(locdict.get(x-1, y, z))
-                c2 = not test(locdict.get(x+1, y, z))
-                ic1 = test(locdict.get(x-1, y+1, z))
-                ic2 = test(locdict.get(x+1, y+1, z))
+                c1, c2, ic1, ic2 = not west, not east, nw, ne
                 # Correctly swap if we're doing an inside wall
                 if inside:
                     wall = (x+1, y+1, x, y+1, z, 0, -w)
@@ -332,19 +528,20 @@ class InGameController(BaseController):
                     wall = (x, y+1, x+1, y+1, z, 0, w)
                 # Work out what kind of chamfer is needed
                 chamfer = (-w if c1 else w if ic1 else 0, 0, w if c2 else -w if ic2 else 0, 0)
-                draw_walls.append(wall + chamfer)
+                draw_walls.append(wall + chamfer + (door_sides & NORTH,))
+        # Join the unit edges up into straight runs
+        draw_walls = merge_wall_runs(draw_walls)
         # For each wall in the lot we have to draw, make it.
         # (note: only one half of the wall is drawn; outer for expanses, inner for rooms)
-        for x, y, x2, y2, z, dx, dy, t1x, t1y, t2x, t2y in draw_walls:
-            # Work out the correct UV coords offset to get the textures straight
-            if x2 != x:
-                du1 = t1x / (x2 - x)
-                du2 = t2x / (x2 - x)
-            else:
-                du1 = t1y / (y2 - y) 
-                du2 = t2y / (y2 - y)
+        for x, y, x2, y2, z, dx, dy, t1x, t1y, t2x, t2y, door in draw_walls:
+            # Work out the correct UV coords offset to get the textures
+            # straight; the texture repeats once per square along the run.
+            length = abs(x2 - x) + abs(y2 - y)
+            ux, uy = (x2 - x) / float(length), (y2 - y) / float(length)
+            du1 = t1x * ux + t1y * uy
+            du2 = t2x * ux + t2y * uy
             # Is there a door on this wall?
-            if (x, y, x2, y2, z) in doordict:
+            if door:
                 ## Params ##
                 dw = 0.8 # Width of door
                 dh = 0.65 # Height of door
@@ -377,24 +574,18 @@ class InGameController(BaseController):
             else:
                 points = [(
                     (x2+dx+t2x, y2+dy+t2y, 0, 0-du2, 0),
-                    (x+dx+t1x, y+dy+t1y, 0, 1-du1, 0),
+                    (x+dx+t1x, y+dy+t1y, 0, length-du1, 0),
                     (x2+dx+t2x, y2+dy+t2y, h, 0-du2, 0.9),
-                    (x+dx+t1x, y+dy+t1y, h, 1-du1, 0.9),
+                    (x+dx+t1x, y+dy+t1y, h, length-du1, 0.9),
                     (x2, y2, h, 0, 1),
-                    (x, y, h, 1, 1)
+                    (x, y, h, length, 1)
                 )]
-            # Draw the tristrip for the wall and its top
-            for strip in points:
-                for x, y, z, tx, ty in strip:
-                    vertex.addData3f(x, y, z)
-                    color.addData4f(1, 1, 1, 1)
-                    texcoord.addData2f(tx, ty)
-                prim.addNextVertices(len(strip)) 
-                prim.closePrimitive()
+            # Queue the tristrip for the wall and its top
+            strips.extend(points)
         # Make a Geom and return
-        geom = Geom(vdata)
-        geom.addPrimitive(prim)
-        return geom
+        builder = MeshBuilder("walls")
+        builder.add_strips(strips)
+        return builder.make_geom()
     
     
     def create_doors(self, root, doors):
@@ -412,55 +603,99 @@ class InGameController(BaseController):
         return door_root
 
     
-    def create_floor(self, item, locdict):
-        """Makes a floor for the given item"""
-        vdata, vertex, color, texcoord = make_vertex_data("polygon")
-        prim = GeomTristrips(Geom.UHStatic)
-        # Add each tile
-        for x, y, z in locdict.coords_for_item(item):
-            for x, y, tx, ty in (
-                    (x, y+1, 0, 1),
-                    (x, y, 0, 0),
-                    (x+1, y+1, 1, 1),
-                    (x+1, y, 1, 0),
-                ):
-                vertex.addData3f(x, y, z)
-                color.addData4f(1, 1, 1, 1)
-                texcoord.addData2f(tx, ty)
-            prim.addNextVertices(4) 
-            prim.closePrimitive()
+    def create_floor(self, item, locdict, coords=None):
+        """
+        Makes a floor for the given item (or just the given coords of it), as
+        a few big quads rather than one per tile; texture coordinates run in
+        tiles, so the texture repeats.
+        """
+        builder = MeshBuilder("polygon")
+        if coords is None:
+            coords = locdict.coords_for_item(item)
+        # Sort the tiles by level, then mesh each level
+        levels = {}
+        for x, y, z in coords:
+            levels.setdefault(z, []).append((x, y))
+        for z, squares in levels.items():
+            rects = numpy.array(greedy_rectangles(squares), dtype=numpy.float32).reshape(-1, 4)
+            x1, y1, x2, y2 = rects.T
+            width, height = x2 - x1, y2 - y1
+            zs = numpy.full(len(rects), z, dtype=numpy.float32)
+            zeros = numpy.zeros(len(rects), dtype=numpy.float32)
+            # Each rectangle is a four-point strip
+            builder.add_strips(numpy.stack([
+                numpy.column_stack(corner)
+                for corner in (
+                    (x1, y2, zs, zeros, height),
+                    (x1, y1, zs, zeros, zeros),
+                    (x2, y2, zs, width, height),
+                    (x2, y1, zs, width, zeros),
+                )
+            ], axis=1))
         # Make a Geom and return
-        geom = Geom(vdata)
-        geom.addPrimitive(prim)
-        return geom
+        return builder.make_geom()
+    
+    
+    def create_chunk(self, world, cx, cy, z):
+        """
+        Creates the scenery (floors, walls and doors) for one CHUNK_SIZE
+        square of a level, all under one node, so Panda can cull chunks
+        that are off-screen.
+        """
+        size = self.CHUNK_SIZE
+        x1, y1 = cx * size, cy * size
+        rooms = {}
+        for x, y, z, room in world.rooms.query_rect(x1, y1, x1 + size, y1 + size, z):
+            rooms.setdefault(room, []).append((x, y, z))
+        if not rooms:
+            return None
+        root = self.root.attachNewNode("chunk_%i_%i_%i" % (cx, cy, z))
+        self.create_outer_walls(world, root, [coord for coords in rooms.values() for coord in coords])
+        for room, coords in rooms.items():
+            self.create_room(world, room, root, coords)
+        # Each door belongs to the chunk of the square (with a room) it's
+        # on the side of, so doors out onto empty squares still get made,
+        # and doors between two chunks only get made once
+        doors = []
+        for door in world.doors.doors_in_rect(x1, y1, x1 + size, y1 + size, z):
+            owners = [
+                (sx, sy)
+                for sx, sy, side in world.doors.squares_for(*door)
+                if world.rooms.get(sx, sy, z) is not None
+            ]
+            if owners and x1 <= owners[0][0] < x1 + size and y1 <= owners[0][1] < y1 + size:
+                doors.append(door)
+        self.create_doors(root, doors)
+        self.chunks[cx, cy, z] = root
+        return root
     
     
-    def create_outer_walls(self, world):
-        "Creates the model for an Expanse (i.e. outer walls; floors come from Rooms)."
+    def create_outer_walls(self, world, root, coords):
+        "Creates the model for an Expanse (i.e. outer walls; floors come from Rooms) around the given coords."
         # Make a geom for the walls
-        geom = self.create_wall(world.rooms.all_coords(), world.rooms, world.doors)
+        geom = self.create_wall(coords, world.rooms, world.doors)
         wall_node = GeomNode('walls')
         wall_node.addGeom(geom)
         # Add a nodepath 'n' texture
-        root = self.root.attachNewNode("expanse")
+        root = root.attachNewNode("expanse")
         wall_nodepath = root.attachNewNode(wall_node)
         tex = loader.loadTexture('textures/wall_1.png')
         wall_nodepath.setTexture(tex)
         return root
     
     
-    def create_room(self, world, room):
-        "Creates the model for an Room (i.e. inner walls and a floor)."
+    def create_room(self, world, room, root, coords):
+        "Creates the model for (the given coords of) a Room (i.e. inner walls and a floor)."
         # Make a geom for the walls
-        geom = self.create_wall(room, world.rooms, world.doors, inside=True)
+        geom = self.create_wall(room, world.rooms, world.doors, inside=True, coords=coords)
         wall_node = GeomNode('walls')
         wall_node.addGeom(geom)
         # And one for the floor
-        geom = self.create_floor(room, world.rooms)
+        geom = self.create_floor(room, world.rooms, coords)
         floor_node = GeomNode('floor')
         floor_node.addGeom(geom)
         # Attach and combine
-        root = self.root.attachNewNode("expanse")
+        root = root.attachNewNode(room.type)
         wall_nodepath = root.attachNewNode(wall_node)
         tex = loader.loadTexture(self.ROOM_TEXTURES[room.type][0])
         wall_nodepath.setTexture(tex)
@@ -468,15 +703,18 @@ class InGameController(BaseController):
         floor_nodepath.setPos(0, 0, 0.05)
         tex = loader.loadTexture(self.ROOM_TEXTURES[room.type][1])
         floor_nodepath.setTexture(tex)
-        # Load on the door models
-        self.create_doors(root, world.doors)
+        return root
     
     
-    def create_item(self, world, item):
-        "Creates a node for an Item and sticks a model in it."
+    def create_item(self, world, placement):
+        "Creates a node for a placed Item and sticks a model in it."
+        item, x, y, z, rot = world.items.placement(placement)
         # Make a new node for the item
         item_root = self.root.attachNewNode(item.name)
-        item_root.setPos(*item.origin)
+        # Turn it, then move it back onto its footprint
+        sx, sy = item.footprint(rot).shift
+        item_root.setPos(x + sx, y + sy, z)
+        item_root.setH(90.0 * rot)
         # Load a model, add it
         model = loader.loadModel("items/%s" % item.model)
         model.reparentTo(item_root)
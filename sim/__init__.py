@@ -0,0 +1,287 @@
+"""
+Headless passenger simulation. Nothing in here touches Panda3D; the
+renderer just reads the agent arrays.
+"""
+
+import datetime
+
+import numpy
+
+from world.constants import NORTH, EAST, SOUTH, WEST
+from world.flowfield import FlowField, grid_array
+from sim.spatial import SpatialHash
+from sim.events import Scheduler
+
+# Agent states. EMPTY marks a free slot in the arrays.
+EMPTY, WALKING, WAITING, ARRIVED = range(4)
+
+
+class Simulation(object):
+
+    """
+    All agents, kept as parallel NumPy arrays (struct-of-arrays) rather than
+    one object each:
+
+        positions   float32 (n, 2)  where they are, in squares
+        velocities  float32 (n, 2)  how fast they're going, squares/second
+        speeds      float32 (n,)    how fast they like to walk
+        goals       int16 (n,)      index of the destination they're after
+        states      uint8 (n,)      EMPTY, WALKING, WAITING or ARRIVED
+        timers      float32 (n,)    seconds left WAITING before walking on
+
+    step(dt) advances everyone at once; run(seconds) does that in fixed
+    TICK-sized steps. Destinations are FlowFields, so any number of agents
+    can share one at no extra cost. Agents closer than PERSONAL_SPACE push
+    each other apart (found with a SpatialHash rebuilt every step), and
+    nobody is let through a wall.
+
+    'time' is game seconds since START; anything that happens at a known
+    time goes on the 'events' Scheduler, which each step runs up to now.
+    """
+
+    TICK = 0.1
+    WALKING_SPEED = 1.3
+    PERSONAL_SPACE = 0.6
+    SEPARATION = 2.0
+    START = datetime.datetime(2011, 5, 13, 20, 14)
+
+    def __init__(self, world, z=0, capacity=1024):
+        self.world = world
+        self.z = z
+        self.time = 0.0
+        self.events = Scheduler()
+        self.destinations = []
+        self.fields = []
+        self._leftover = 0.0
+        self.positions = numpy.zeros((capacity, 2), dtype=numpy.float32)
+        self.velocities = numpy.zeros((capacity, 2), dtype=numpy.float32)
+        self.speeds = numpy.zeros(capacity, dtype=numpy.float32)
+        self.goals = numpy.full(capacity, -1, dtype=numpy.int16)
+        self.states = numpy.zeros(capacity, dtype=numpy.uint8)
+        self.timers = numpy.zeros(capacity, dtype=numpy.float32)
+        self.hash = SpatialHash(self.PERSONAL_SPACE)
+        self._load_layout()
+        # Rebuilding takes a while, so do it at most once a step
+        self._stale = False
+        world.rooms.listen(self._world_changed)
+        world.doors.listen(self._world_changed)
+
+
+    def __len__(self):
+        "Returns the number of agents."
+        return int(numpy.count_nonzero(self.states))
+
+
+    def now(self, time=None):
+        "Returns the current game time (or 'time' seconds in) as a datetime."
+        if time is None:
+            time = self.time
+        return self.START + datetime.timedelta(seconds=time)
+
+
+    def add_destination(self, name, squares):
+        "Adds a destination made up of the given (x, y) squares; returns its index."
+        self.destinations.append(name)
+        self.fields.append(FlowField(self.world, squares, self.z))
+        return len(self.fields) - 1
+
+
+    def refresh_destinations(self):
+        "Rebuilds every destination's flow field (e.g. after building)."
+        self._stale = False
+        self._load_layout()
+        self.fields = [
+            FlowField(self.world, field.targets, self.z)
+            for field in self.fields
+        ]
+
+
+    def _world_changed(self, x1, y1, x2, y2, z):
+        if z == self.z:
+            self._stale = True
+
+
+    def close(self):
+        "Stops listening for changes to the world; the simulation is done with."
+        self.world.rooms.unlisten(self._world_changed)
+        self.world.doors.unlisten(self._world_changed)
+
+
+    def _load_layout(self):
+        "Takes a copy of the level's rooms and doors, to keep agents out of walls."
+        grid = self.world.rooms.level(self.z)
+        bounds = grid.bounds() if grid is not None else None
+        x1, y1, x2, y2 = bounds if bounds is not None else (0, 0, 0, 0)
+        # Padded by a square each side, like a FlowField
+        self._layout_origin = numpy.array((x1 - 1, y1 - 1))
+        self._room_ids = numpy.zeros((x2 - x1 + 2, y2 - y1 + 2), dtype=numpy.int32)
+        self._door_sides = numpy.zeros(self._room_ids.shape, dtype=numpy.uint8)
+        if x2 > x1:
+            self._room_ids[1:-1, 1:-1] = grid_array(grid, x1, y1, x2, y2)
+            door_grid = self.world.doors.level(self.z)
+            if door_grid is not None:
+                self._door_sides[1:-1, 1:-1] = grid_array(door_grid, x1, y1, x2, y2)
+
+
+    def _passable(self, starts, ends, sides):
+        """
+        Says, for arrays of neighbouring squares, whether you can step from
+        each start to its end: it's the same room, or there's a door on that
+        side. Off the layout counts as one big room.
+        """
+        w, h = self._room_ids.shape
+        starts = starts - self._layout_origin
+        ends = ends - self._layout_origin
+        sx, sy = numpy.clip(starts[:, 0], 0, w - 1), numpy.clip(starts[:, 1], 0, h - 1)
+        ex, ey = numpy.clip(ends[:, 0], 0, w - 1), numpy.clip(ends[:, 1], 0, h - 1)
+        return (self._room_ids[sx, sy] == self._room_ids[ex, ey]) | (self._door_sides[sx, sy] & sides != 0)
+
+
+    def _grow(self, capacity):
+        "Makes the arrays big enough for capacity agents."
+        old = len(self.states)
+        if capacity <= old:
+            return
+        capacity = max(capacity, old * 2)
+        for name, fill in (("positions", 0), ("velocities", 0), ("speeds", 0), ("goals", -1), ("states", EMPTY), ("timers", 0)):
+            array = getattr(self, name)
+            grown = numpy.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:old] = array
+            setattr(self, name, grown)
+
+
+    def spawn(self, positions, goal, speed=None, wait=0.0):
+        """
+        Adds agents at the given (n, 2) positions, heading for destination
+        goal after waiting 'wait' seconds. Returns their indices.
+        """
+        positions = numpy.asarray(positions, dtype=numpy.float32).reshape(-1, 2)
+        free = numpy.flatnonzero(self.states == EMPTY)
+        if len(free) < len(positions):
+            self._grow(len(self.states) + len(positions) - len(free))
+            free = numpy.flatnonzero(self.states == EMPTY)
+        indices = free[:len(positions)]
+        self.positions[indices] = positions
+        self.velocities[indices] = 0
+        self.speeds[indices] = self.WALKING_SPEED if speed is None else speed
+        self.goals[indices] = goal
+        self.timers[indices] = wait
+        self.states[indices] = WAITING if wait > 0 else WALKING
+        return indices
+
+
+    def despawn(self, indices):
+        "Removes the given agents."
+        self.states[indices] = EMPTY
+        self.goals[indices] = -1
+        self.velocities[indices] = 0
+
+
+    def set_goal(self, indices, goal):
+        "Sends the given agents off towards another destination."
+        self.goals[indices] = goal
+        self.states[indices] = WALKING
+
+
+    def run(self, seconds):
+        """
+        Advances the simulation by 'seconds' of game time in fixed TICK-sized
+        steps, carrying any remainder over to next time. Returns the number
+        of steps taken.
+        """
+        self._leftover += seconds
+        steps = int(self._leftover / self.TICK)
+        self._leftover -= steps * self.TICK
+        for i in range(steps):
+            self.step(self.TICK)
+        return steps
+
+
+    def step(self, dt):
+        "Fires any events now due, then advances every agent by dt seconds."
+        self.events.run_until(self.time)
+        if self._stale:
+            self.refresh_destinations()
+        states = self.states
+        # Count down the waiters, and set off any that are done
+        waiting = states == WAITING
+        if waiting.any():
+            self.timers[waiting] -= dt
+            states[waiting & (self.timers <= 0)] = WALKING
+        # Steer the walkers along their destination's flow field. Those who've
+        # arrived are checked too, as the crowd can push them off again.
+        self.velocities[states != WALKING] = 0
+        for goal, field in enumerate(self.fields):
+            walkers = numpy.flatnonzero(((states == WALKING) | (states == ARRIVED)) & (self.goals == goal))
+            if not len(walkers):
+                continue
+            positions = self.positions[walkers]
+            squares = numpy.floor(positions).astype(numpy.intp)
+            dxs, dys = field.steps(squares[:, 0], squares[:, 1])
+            # Head for the middle of the next square along
+            heading = squares + 0.5 + numpy.column_stack((dxs, dys)) - positions
+            lengths = numpy.sqrt((heading ** 2).sum(axis=1))
+            # Those on a target square have arrived, and anyone pushed off
+            # one walks back; those with nowhere to go (off the field, or
+            # stranded) stand still.
+            still = (dxs == 0) & (dys == 0)
+            ox, oy = field.origin
+            w, h = field.distances.shape
+            inside = (squares[:, 0] >= ox) & (squares[:, 0] < ox + w) & (squares[:, 1] >= oy) & (squares[:, 1] < oy + h)
+            at_target = numpy.zeros(len(walkers), dtype=bool)
+            at_target[inside] = field.distances[squares[inside, 0] - ox, squares[inside, 1] - oy] == 0
+            moving = ~still & ~at_target
+            scale = numpy.where(moving & (lengths > 0), self.speeds[walkers] / numpy.maximum(lengths, 1e-6), 0)
+            self.velocities[walkers] = heading * scale[:, None]
+            states[walkers] = numpy.where(at_target, ARRIVED, WALKING)
+        self._separate()
+        self._move(dt)
+        self.time += dt
+
+
+    def _separate(self):
+        """
+        Adds a push apart to the velocity of anyone crowding anyone else.
+        Walkers and those who've arrived get moved; waiters hold their ground.
+        """
+        self.hash.rebuild(self.positions, numpy.flatnonzero(self.states != EMPTY))
+        firsts, seconds, offsets, distances = self.hash.pairs(self.PERSONAL_SPACE)
+        if not len(firsts):
+            return
+        # Push harder the more they overlap; both get pushed equally
+        strength = self.SEPARATION * (self.PERSONAL_SPACE - distances) / numpy.maximum(distances, 1e-3)
+        pushes = offsets * strength[:, None]
+        n = len(self.states)
+        forces = numpy.empty((n, 2), dtype=numpy.float32)
+        for axis in (0, 1):
+            forces[:, axis] = numpy.bincount(firsts, pushes[:, axis], n) - numpy.bincount(seconds, pushes[:, axis], n)
+        forces[(self.states != WALKING) & (self.states != ARRIVED)] = 0
+        self.velocities += forces
+        # Nobody gets shoved along faster than they can run
+        limit = self.speeds * 1.5
+        speeds = numpy.sqrt((self.velocities ** 2).sum(axis=1))
+        fast = speeds > limit
+        self.velocities[fast] *= (limit[fast] / speeds[fast])[:, None]
+
+
+    def _move(self, dt):
+        """
+        Moves everyone along their velocity, except across walls: a move
+        into a square you can't step to is cancelled along that axis, so
+        agents slide along walls rather than through them.
+        """
+        positions = self.positions + self.velocities * dt
+        crossed = numpy.flatnonzero((numpy.floor(positions) != numpy.floor(self.positions)).any(axis=1))
+        if len(crossed):
+            starts = numpy.floor(self.positions[crossed]).astype(numpy.intp)
+            ends = numpy.floor(positions[crossed]).astype(numpy.intp)
+            # Check the x move first, then the y move from wherever that left them
+            for axis, (forward, backward) in enumerate(((EAST, WEST), (NORTH, SOUTH))):
+                steps = ends[:, axis] - starts[:, axis]
+                targets = starts.copy()
+                targets[:, axis] = ends[:, axis]
+                blocked = (steps != 0) & ~self._passable(starts, targets, numpy.where(steps > 0, forward, backward))
+                positions[crossed[blocked], axis] = self.positions[crossed[blocked], axis]
+                ends[blocked, axis] = starts[blocked, axis]
+                starts[:, axis] = ends[:, axis]
+        self.positions = positions
@@ -0,0 +1,121 @@
+"""
+Discrete events: things that happen at a known game time (flights
+arriving and leaving, boarding calls, passengers turning up), kept in a
+heap so nothing has to check for them every tick.
+"""
+
+import heapq
+import itertools
+
+
+class Event(object):
+
+    "Something scheduled to happen; 'pending' is False once fired or cancelled."
+
+    __slots__ = ("time", "callback", "args", "pending")
+
+    def __init__(self, time, callback, args):
+        self.time = time
+        self.callback = callback
+        self.args = args
+        self.pending = True
+
+
+    def __repr__(self):
+        return "<Event %s at %.1f>" % (getattr(self.callback, "__name__", self.callback), self.time)
+
+
+class Scheduler(object):
+
+    """
+    A heap of (time, sequence, Event); the sequence number keeps events at
+    the same time in the order they were scheduled. Cancelling just marks
+    the event, and it's thrown away when it reaches the top of the heap,
+    unless cancelled events come to outnumber live ones, in which case the
+    heap is rebuilt without them. Scheduling lots at once uses heapify,
+    which is O(n) rather than O(n log n).
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+
+
+    def __len__(self):
+        "Returns the number of events still to happen."
+        return len(self._heap) - self._cancelled
+
+
+    def schedule(self, time, callback, *args):
+        "Schedules callback(*args) to be called at game time 'time'."
+        event = Event(time, callback, args)
+        heapq.heappush(self._heap, (time, next(self._sequence), event))
+        return event
+
+
+    def schedule_in(self, delay, callback, *args):
+        "Schedules callback(*args) to be called 'delay' seconds from now."
+        return self.schedule(self.now + delay, callback, *args)
+
+
+    def schedule_many(self, events):
+        "Schedules an iterable of (time, callback, args) all at once; returns the Events."
+        entries = [
+            (time, next(self._sequence), Event(time, callback, tuple(args)))
+            for time, callback, args in events
+        ]
+        # Pushing one by one is cheaper only when adding just a few
+        if len(entries) * 4 < len(self._heap):
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+        else:
+            self._heap.extend(entries)
+            heapq.heapify(self._heap)
+        return [entry[2] for entry in entries]
+
+
+    def cancel(self, event):
+        "Stops a pending event from happening. Cancelling twice is harmless."
+        if not event.pending:
+            return
+        event.pending = False
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+            self._heap[:] = [entry for entry in self._heap if entry[2].pending]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+
+    def _discard_cancelled(self):
+        while self._heap and not self._heap[0][2].pending:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+
+    def next_time(self):
+        "Returns when the next event happens, or None if there are none."
+        self._discard_cancelled()
+        return self._heap[0][0] if self._heap else None
+
+
+    def run_until(self, time):
+        """
+        Fires, in order, every event due at or before 'time', then moves the
+        clock on to it. Events scheduled by callbacks fire too if they're
+        due in time. Returns how many events fired.
+        """
+        fired = 0
+        heap = self._heap
+        while True:
+            self._discard_cancelled()
+            if not heap or heap[0][0] > time:
+                break
+            event = heapq.heappop(heap)[2]
+            event.pending = False
+            self.now = max(self.now, event.time)
+            event.callback(*event.args)
+            fired += 1
+        self.now = max(self.now, time)
+        return fired
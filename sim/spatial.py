@@ -0,0 +1,112 @@
+"""
+A uniform spatial hash over agent positions, for finding which agents are
+close to each other without comparing every pair.
+"""
+
+import numpy
+
+# The cell offsets to look in for pairs: the agent's own cell, plus half of
+# the eight around it (the other half find the same pairs from their side).
+HALF_NEIGHBOURHOOD = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+# Large primes for mixing a cell's x and y into one hash
+HASH_X = 73856093
+HASH_Y = 19349663
+
+
+class SpatialHash(object):
+
+    """
+    Buckets points into square cells, rebuilt from scratch every tick. Each
+    cell is hashed into a table of about twice as many buckets as there are
+    points, then sorted by counting sort: a bincount of bucket numbers gives
+    each bucket's size, a cumsum of those gives where each bucket starts,
+    and a stable argsort of the bucket numbers puts the points in bucket
+    order. The table only depends on the number of points, not on how far
+    apart they are, and nothing is kept between rebuilds.
+
+    Different cells can share a bucket, so pairs() checks each candidate's
+    exact cell as well. It finds every pair of points within a radius (no
+    bigger than the cell size) in bulk, only ever looking at neighbouring
+    cells.
+    """
+
+    def __init__(self, cell=1.0):
+        self.cell = float(cell)
+        self.rebuild(numpy.zeros((0, 2), dtype=numpy.float32))
+
+
+    def __len__(self):
+        return len(self.indices)
+
+
+    def _buckets(self, cells):
+        "Returns the bucket number of each of the (n, 2) cells."
+        # The table size is a power of two, so masking works on negatives too
+        return ((cells[:, 0] * HASH_X) ^ (cells[:, 1] * HASH_Y)) & (self.size - 1)
+
+
+    def rebuild(self, positions, indices=None):
+        """
+        Hashes the (n, 2) positions. If indices is given, only those rows
+        are hashed, and results refer to points by those indices.
+        """
+        if indices is None:
+            indices = numpy.arange(len(positions))
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        positions = numpy.asarray(positions)[indices]
+        cells = numpy.floor(positions / self.cell).astype(numpy.int64).reshape(-1, 2)
+        self.size = 1
+        while self.size < 2 * len(cells):
+            self.size *= 2
+        buckets = self._buckets(cells)
+        self.counts = numpy.bincount(buckets, minlength=self.size)
+        self.starts = numpy.cumsum(self.counts) - self.counts
+        order = numpy.argsort(buckets, kind="mergesort")
+        self.cells = cells[order]
+        self.indices = indices[order]
+        self.positions = positions[order]
+
+
+    def pairs(self, radius):
+        """
+        Returns (a, b, offsets, distances) for every pair of points closer
+        than radius, each pair once: a and b are point indices, offsets is
+        the (n, 2) vector from b to a.
+        """
+        if radius > self.cell:
+            raise ValueError("Radius %s is bigger than the cell size %s." % (radius, self.cell))
+        n = len(self.cells)
+        sorted_ids = numpy.arange(n)
+        firsts, seconds = [], []
+        for dx, dy in HALF_NEIGHBOURHOOD:
+            neighbours = self.cells + (dx, dy)
+            buckets = self._buckets(neighbours)
+            if dx == dy == 0:
+                # Within a bucket, only pair with those sorted after you
+                lo = sorted_ids + 1
+                hi = self.starts[buckets] + self.counts[buckets]
+            else:
+                lo = self.starts[buckets]
+                hi = lo + self.counts[buckets]
+            lengths = numpy.maximum(hi - lo, 0)
+            total = lengths.sum()
+            if not total:
+                continue
+            # Expand each point into one entry per candidate partner
+            first = numpy.repeat(sorted_ids, lengths)
+            runs = numpy.cumsum(lengths) - lengths
+            second = numpy.arange(total) - numpy.repeat(runs - lo, lengths)
+            # Drop those that only share the bucket, not the cell
+            right = (self.cells[second] == neighbours[first]).all(axis=1)
+            firsts.append(first[right])
+            seconds.append(second[right])
+        if not firsts:
+            empty = numpy.zeros(0, dtype=numpy.intp)
+            return empty, empty, numpy.zeros((0, 2), dtype=self.positions.dtype), numpy.zeros(0, dtype=self.positions.dtype)
+        first = numpy.concatenate(firsts)
+        second = numpy.concatenate(seconds)
+        offsets = self.positions[first] - self.positions[second]
+        distances = numpy.sqrt((offsets ** 2).sum(axis=1))
+        close = distances < radius
+        return self.indices[first[close]], self.indices[second[close]], offsets[close], distances[close]
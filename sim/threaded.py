@@ -0,0 +1,127 @@
+"""
+Runs a Simulation on its own thread, so a heavy tick never holds up the
+renderer. The renderer only ever sees snapshots.
+"""
+
+import time
+import Queue
+import threading
+
+import numpy
+
+from sim import EMPTY
+
+
+class Snapshot(object):
+
+    "A frozen copy of where every agent was at one moment of game time."
+
+    __slots__ = ("time", "published", "positions", "states")
+
+    def __init__(self, sim=None):
+        if sim is None:
+            self.time = 0.0
+            self.positions = numpy.zeros((0, 2), dtype=numpy.float32)
+            self.states = numpy.zeros(0, dtype=numpy.uint8)
+        else:
+            self.time = sim.time
+            self.positions = sim.positions.copy()
+            self.states = sim.states.copy()
+        self.published = time.time()
+
+
+class SimulationThread(threading.Thread):
+
+    """
+    Steps a Simulation in fixed ticks, paced so game time runs 'speed' times
+    faster than real time, and after each tick publishes a Snapshot. The two
+    latest snapshots are kept as a front/back pair, swapped under a lock;
+    snapshots are never written once published, so the renderer can read
+    its pair at leisure while the next one is built.
+
+    Anything that touches the simulation or world from outside (building,
+    spawning, scheduling) must go through call(), which runs it on this
+    thread between ticks.
+    """
+
+    # Never try to catch up more than this many real seconds at once
+    MAX_LAG = 0.5
+
+    def __init__(self, sim, speed=1.0):
+        threading.Thread.__init__(self, name="Simulation")
+        self.daemon = True
+        self.sim = sim
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._commands = Queue.Queue()
+        self._stopping = threading.Event()
+        self._previous = self._current = Snapshot(sim)
+
+
+    def call(self, function, *args):
+        "Runs function(*args) on the simulation thread before its next tick."
+        self._commands.put((function, args))
+
+
+    def stop(self):
+        "Asks the thread to finish, and waits for it to."
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+
+
+    def _run_commands(self):
+        while True:
+            try:
+                function, args = self._commands.get_nowait()
+            except Queue.Empty:
+                return
+            function(*args)
+
+
+    def run(self):
+        tick = self.sim.TICK
+        last = time.time()
+        owed = 0.0
+        while not self._stopping.is_set():
+            self._run_commands()
+            now = time.time()
+            owed = min(owed + (now - last) * self.speed, self.MAX_LAG * self.speed + tick)
+            last = now
+            if owed < tick:
+                time.sleep((tick - owed) / self.speed)
+                continue
+            self.sim.step(tick)
+            owed -= tick
+            snapshot = Snapshot(self.sim)
+            with self._lock:
+                self._previous, self._current = self._current, snapshot
+
+
+    def snapshots(self):
+        "Returns the latest two snapshots, as (previous, current)."
+        with self._lock:
+            return self._previous, self._current
+
+
+    def interpolated(self, now=None):
+        """
+        Returns (game time, positions, indices) for drawing at real time
+        'now': one tick behind the simulation, blending the last two
+        snapshots so agents move smoothly whatever the frame rate. indices
+        are the agents present; positions is indexed by agent like the
+        Simulation's own arrays.
+        """
+        previous, current = self.snapshots()
+        if now is None:
+            now = time.time()
+        span = current.time - previous.time
+        if span > 0:
+            alpha = min(max((now - current.published) * self.speed / span, 0.0), 1.0)
+        else:
+            alpha = 1.0
+        positions = current.positions.copy()
+        n = min(len(previous.states), len(current.states))
+        both = numpy.flatnonzero((previous.states[:n] != EMPTY) & (current.states[:n] != EMPTY))
+        positions[both] = previous.positions[both] + (current.positions[both] - previous.positions[both]) * alpha
+        return previous.time + span * alpha, positions, numpy.flatnonzero(current.states != EMPTY)
@@ -0,0 +1,100 @@
+"""
+Runs the passenger simulation without any rendering (or Panda3D), as fast
+as the CPU allows, and reports how quickly it went. For benchmarking and
+capacity planning:
+
+    python simulate.py --hours 24 --flights 10 --passengers 150
+"""
+
+import sys
+import time
+import random
+import optparse
+
+import numpy
+
+from world import build_test_world
+from sim import Simulation, ARRIVED
+
+
+def room_squares(world, type):
+    "Returns the (x, y, z) squares of all rooms of the given type."
+    return [
+        coord
+        for room, coords in world.rooms.items()
+        if room.type == type
+        for coord in coords
+    ]
+
+
+class Flight(object):
+
+    "A departing flight, and the passengers turning up for it."
+
+    def __init__(self, code, departs):
+        self.code = code
+        self.departs = departs
+        self.passengers = []
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--hours", type="float", default=1.0, help="game hours to simulate (default 1)")
+    parser.add_option("--flights", type="float", default=6, help="departures per game hour (default 6)")
+    parser.add_option("--passengers", type="int", default=100, help="passengers per flight (default 100)")
+    parser.add_option("--tick", type="float", default=Simulation.TICK, help="seconds of game time per tick (default %s)" % Simulation.TICK)
+    parser.add_option("--entrance", default="corridor", help="room type passengers appear in")
+    parser.add_option("--destination", default="lounge", help="room type passengers head for")
+    parser.add_option("--seed", type="int", default=0, help="random seed")
+    options, args = parser.parse_args(argv)
+    random.seed(options.seed)
+    
+    world = build_test_world()
+    entrances = room_squares(world, options.entrance)
+    targets = room_squares(world, options.destination)
+    if not entrances or not targets:
+        parser.error("The world has no %s or no %s." % (options.entrance, options.destination))
+    z = entrances[0][2]
+    sim = Simulation(world, z)
+    goal = sim.add_destination(options.destination, [(x, y) for x, y, tz in targets if tz == z])
+    stats = {"spawned": 0, "boarded": 0, "missed": 0, "peak": 0}
+    
+    def arrive(flight):
+        "A passenger turns up somewhere in the entrance and heads for the lounge."
+        x, y, tz = random.choice(entrances)
+        flight.passengers.extend(sim.spawn([(x + random.random(), y + random.random())], goal))
+        stats["spawned"] += 1
+        stats["peak"] = max(stats["peak"], len(sim))
+    
+    def depart(flight):
+        "Whoever made it to the lounge boards; everyone else has missed it."
+        passengers = numpy.array(flight.passengers, dtype=numpy.intp)
+        boarded = int((sim.states[passengers] == ARRIVED).sum()) if len(passengers) else 0
+        stats["boarded"] += boarded
+        stats["missed"] += len(passengers) - boarded
+        sim.despawn(passengers)
+    
+    # Queue up the whole run's flights and arrivals in one go. Passengers
+    # turn up between 90 and 20 minutes before their flight.
+    duration = options.hours * 3600
+    events = []
+    for i in range(int(options.hours * options.flights)):
+        flight = Flight("AM%03i" % i, (i + random.random()) * 3600 / options.flights)
+        events.append((flight.departs, depart, (flight,)))
+        for j in range(options.passengers):
+            events.append((max(0, flight.departs - random.uniform(20 * 60, 90 * 60)), arrive, (flight,)))
+    sim.events.schedule_many(events)
+    
+    ticks = int(duration / options.tick)
+    start = time.time()
+    for tick in xrange(ticks):
+        sim.step(options.tick)
+    elapsed = time.time() - start
+    
+    print "Simulated %.2f game hours (%i ticks, %i events) in %.2fs wall-clock." % (options.hours, ticks, len(events), elapsed)
+    print "%.0f ticks/s, %.0fx real time." % (ticks / max(elapsed, 1e-9), duration / max(elapsed, 1e-9))
+    print "%(spawned)i passengers turned up, %(boarded)i boarded, %(missed)i missed their flight, %(peak)i in the airport at most." % stats
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 
 from world.locdict import LocDict, ItemDict, DoorDict
+from world.graph import RoomGraph
 from world.constants import *
 
 class World(object):
@@ -13,6 +14,7 @@ class World(object):
         self.rooms = LocDict()
         self.doors = DoorDict()
         self.items = ItemDict()
+        self.graph = RoomGraph(self.rooms, self.doors)
         self.size = (sizex, sizey)
     
     
@@ -22,12 +24,45 @@ class World(object):
             self.rooms.add(x, y, z, room)
     
     
+    def add_room_rect(self, room, x1, y1, x2, y2, z):
+        "Adds the given rectangle (x2, y2 exclusive) of squares to a Room."
+        self.rooms.fill_rect(x1, y1, x2, y2, z, room)
+    
+    
     def add_door(self, x1, y1, x2, y2, z):
         self.doors.add(x1, y1, x2, y2, z)
     
     
+    def remove_door(self, x1, y1, x2, y2, z):
+        self.doors.remove(x1, y1, x2, y2, z)
+    
+    
+    def listen(self, listener):
+        """
+        Calls listener(x1, y1, x2, y2, z) with the region changed by any
+        edit to the rooms, doors or items.
+        """
+        for notifier in (self.rooms, self.doors, self.items):
+            notifier.listen(listener)
+    
+    
+    def chunk_generation(self, cx, cy, z):
+        """
+        Returns a number that changes whenever rooms, items or doors change
+        anywhere in chunk (cx, cy) of level z. (Each part's generations
+        only ever go up, so their sum changes whenever any of them does.)
+        """
+        total = 0
+        for locdict in (self.rooms, self.items, self.doors):
+            grid = locdict.level(z)
+            if grid is not None:
+                total += grid.generation(cx, cy)
+        return total
+    
+    
     def add_item(self, item, x, y, z, rot):
-        self.items.add(x, y, z, rot, item)
+        "Places an Item, returning the placement ID."
+        return self.items.add(x, y, z, rot, item)
     
     
     
@@ -44,8 +79,8 @@ def build_test_world():
     from world.item import Item
     
     world = World((1024, 1024))
-    room = Room.from_coords(world, "corridor", range2d(3, 1, 9, 9, 0))
-    room = Room.from_coords(world, "lounge", range2d(1, 1, 3, 9, 0))
+    room = Room.from_rect(world, "corridor", 3, 1, 9, 9, 0)
+    room = Room.from_rect(world, "lounge", 1, 1, 3, 9, 0)
     world.add_door(3, 2, 3, 3, 0)
     
     item = Item("departures-board", "Departures Board", "screens", USES_NONFLOOR)
@@ -6,5 +6,11 @@ Various useful constants.
 USES_FLOOR = 1
 USES_LOWER = 2
 USES_UPPER = 4
-USES_NONFLOOR = USES_LOWER & USES_UPPER
-USES_ALL = USES_FLOOR & USES_NONFLOOR
\ No newline at end of file
+USES_NONFLOOR = USES_LOWER | USES_UPPER
+USES_ALL = USES_FLOOR | USES_NONFLOOR
+
+# Sides of a square, as used in door masks. North is +y, east is +x.
+NORTH = 1
+EAST = 2
+SOUTH = 4
+WEST = 8
\ No newline at end of file
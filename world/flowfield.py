@@ -0,0 +1,142 @@
+"""
+Flow fields: one breadth-first search outwards from a destination, which
+any number of agents can then follow towards it.
+"""
+
+import numpy
+
+from world.constants import NORTH, EAST, SOUTH, WEST
+
+# Direction codes stored in FlowField.directions, and the (dx, dy) of each.
+HERE, GO_NORTH, GO_EAST, GO_SOUTH, GO_WEST = range(5)
+STEPS = numpy.array([(0, 0), (0, 1), (1, 0), (0, -1), (-1, 0)], dtype=numpy.int8)
+
+
+def grid_array(grid, x1, y1, x2, y2):
+    """
+    Copies the region x1 <= x < x2, y1 <= y < y2 of a ChunkGrid into a
+    NumPy array indexed [x - x1, y - y1], a chunk at a time.
+    """
+    result = numpy.zeros((x2 - x1, y2 - y1), dtype=numpy.dtype(grid.typecode))
+    shift, size = grid.SHIFT, grid.SIZE
+    for cx in range(x1 >> shift, ((x2 - 1) >> shift) + 1):
+        for cy in range(y1 >> shift, ((y2 - 1) >> shift) + 1):
+            chunk = grid.chunk(cx, cy)
+            if chunk is None:
+                continue
+            cells = numpy.frombuffer(chunk, dtype=result.dtype).reshape(size, size)
+            bx, by = cx << shift, cy << shift
+            lx1, lx2 = max(x1 - bx, 0), min(x2 - bx, size)
+            ly1, ly2 = max(y1 - by, 0), min(y2 - by, size)
+            result[bx + lx1 - x1:bx + lx2 - x1, by + ly1 - y1:by + ly2 - y1] = cells[lx1:lx2, ly1:ly2]
+    return result
+
+
+class FlowField(object):
+    
+    """
+    The result of a multi-source breadth-first search over one level of a
+    World, out from a set of target squares. Movement follows the same rules
+    as the Pathfinder (straight moves only): free within a room, through
+    doors between rooms.
+    
+    The search is done as NumPy wavefront sweeps: each sweep takes the whole
+    frontier and expands it in the four directions at once. What's left is
+    'distances' (steps to the nearest target, -1 if unreachable) and
+    'directions' (which way to step from each square, as a GO_* code);
+    both are arrays indexed [x - origin x, y - origin y]. A level with no
+    rooms gives an empty field. 'targets' keeps the squares it was asked
+    for, so it can be rebuilt after the level changes.
+    """
+    
+    def __init__(self, world, targets, z):
+        self.z = z
+        self.targets = targets = list(targets)
+        grid = world.rooms.level(z)
+        bounds = grid.bounds() if grid is not None else None
+        if bounds is None:
+            # No rooms on the level, so nothing is reachable
+            grid, bounds = None, (0, 0, 0, 0)
+        x1, y1, x2, y2 = bounds
+        self.origin = (x1, y1)
+        width, height = x2 - x1, y2 - y1
+        # Pad everything by a square each side, so neighbours never wrap
+        # around or fall off the edge.
+        ids = numpy.zeros((width + 2, height + 2), dtype=numpy.int32)
+        if grid is not None:
+            ids[1:-1, 1:-1] = grid_array(grid, x1, y1, x2, y2)
+        doors = numpy.zeros((width + 2, height + 2), dtype=numpy.uint8)
+        door_grid = world.doors.level(z)
+        if door_grid is not None:
+            doors[1:-1, 1:-1] = grid_array(door_grid, x1, y1, x2, y2)
+        ids, doors = ids.ravel(), doors.ravel()
+        stride = height + 2
+        distances = numpy.full(ids.shape, -1, dtype=numpy.int32)
+        directions = numpy.zeros(ids.shape, dtype=numpy.uint8)
+        # Seed the frontier with the targets
+        frontier = numpy.array(
+            [(x - x1 + 1) * stride + (y - y1 + 1) for x, y in targets if x1 <= x < x2 and y1 <= y < y2],
+            dtype=numpy.intp,
+        )
+        frontier = numpy.unique(frontier[ids[frontier] != 0])
+        distances[frontier] = 0
+        # For each direction: the offset from a frontier square to the
+        # neighbour, the side of that neighbour facing back to the frontier,
+        # and the direction code the neighbour should then step in.
+        expansions = (
+            (1, SOUTH, GO_SOUTH),
+            (stride, WEST, GO_WEST),
+            (-1, NORTH, GO_NORTH),
+            (-stride, EAST, GO_EAST),
+        )
+        distance = 0
+        while frontier.size:
+            distance += 1
+            reached = []
+            for offset, side, code in expansions:
+                neighbours = frontier + offset
+                here = ids[neighbours]
+                ok = (here != 0) & (distances[neighbours] == -1) & (
+                    (here == ids[frontier]) | (doors[neighbours] & side != 0)
+                )
+                neighbours = neighbours[ok]
+                distances[neighbours] = distance
+                directions[neighbours] = code
+                reached.append(neighbours)
+            frontier = numpy.concatenate(reached)
+        self.distances = distances.reshape(width + 2, height + 2)[1:-1, 1:-1]
+        self.directions = directions.reshape(width + 2, height + 2)[1:-1, 1:-1]
+    
+    
+    def direction_at(self, x, y):
+        "Returns the (dx, dy) step to take from square x, y."
+        ox, oy = self.origin
+        w, h = self.directions.shape
+        if 0 <= x - ox < w and 0 <= y - oy < h:
+            return tuple(STEPS[self.directions[x - ox, y - oy]])
+        return (0, 0)
+    
+    
+    def steps(self, xs, ys):
+        """
+        Looks up the step for many squares at once; xs and ys are integer
+        arrays. Returns (dxs, dys) arrays; squares off the field get (0, 0).
+        """
+        ox, oy = self.origin
+        w, h = self.directions.shape
+        xs = numpy.asarray(xs) - ox
+        ys = numpy.asarray(ys) - oy
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        codes = numpy.zeros(xs.shape, dtype=numpy.uint8)
+        codes[inside] = self.directions[xs[inside], ys[inside]]
+        steps = STEPS[codes]
+        return steps[..., 0], steps[..., 1]
+    
+    
+    def distance_at(self, x, y):
+        "Returns the number of steps from x, y to the nearest target (-1 if none)."
+        ox, oy = self.origin
+        w, h = self.distances.shape
+        if 0 <= x - ox < w and 0 <= y - oy < h:
+            return int(self.distances[x - ox, y - oy])
+        return -1
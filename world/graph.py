@@ -0,0 +1,117 @@
+
+
+from world.constants import NORTH, EAST, SOUTH, WEST
+
+
+class RoomGraph(object):
+    
+    """
+    Which Rooms connect to which. Rooms are nodes and doors are edges; the
+    outside world (any square that isn't in a room) is the OUTSIDE node.
+    Every boundary between two rooms is walled, so doors are the only way
+    through.
+    
+    It's kept up to date incrementally: it listens to the rooms LocDict and
+    the DoorDict for changed squares, however they were changed, and only
+    re-examines the doors on those squares.
+    """
+    
+    OUTSIDE = None
+    
+    def __init__(self, rooms, doors):
+        self.rooms = rooms
+        self.doors = doors
+        # door -> (room, room) for the two squares either side of it
+        self._door_rooms = {}
+        # room -> {other room: set of doors}
+        self._edges = {}
+        for door in doors:
+            self._update_door(door)
+        rooms.listen(self.squares_changed)
+        doors.listen(self.doors_changed)
+    
+    
+    def _link(self, a, b, door):
+        if a is not b:
+            self._edges.setdefault(a, {}).setdefault(b, set()).add(door)
+            self._edges.setdefault(b, {}).setdefault(a, set()).add(door)
+    
+    
+    def _unlink(self, a, b, door):
+        if a is not b:
+            for x, y in ((a, b), (b, a)):
+                doors = self._edges[x][y]
+                doors.discard(door)
+                if not doors:
+                    del self._edges[x][y]
+                    if not self._edges[x]:
+                        del self._edges[x]
+    
+    
+    def _update_door(self, door):
+        "Works out which rooms a door joins now, and updates the edges."
+        (x1, y1, s1), (x2, y2, s2) = self.doors.squares_for(*door)
+        z = door[4]
+        new = (self.rooms.get(x1, y1, z), self.rooms.get(x2, y2, z))
+        old = self._door_rooms.get(door)
+        if old is not None and old[0] is new[0] and old[1] is new[1]:
+            return
+        if old is not None:
+            self._unlink(old[0], old[1], door)
+        self._door_rooms[door] = new
+        self._link(new[0], new[1], door)
+    
+    
+    def door_added(self, x, y, x2, y2, z):
+        self._update_door(self.doors.normalise(x, y, x2, y2, z))
+    
+    
+    def door_removed(self, x, y, x2, y2, z):
+        door = self.doors.normalise(x, y, x2, y2, z)
+        a, b = self._door_rooms.pop(door)
+        self._unlink(a, b, door)
+    
+    
+    def doors_changed(self, x1, y1, x2, y2, z):
+        "Catches up with doors added or removed on squares x1 <= x < x2, y1 <= y < y2."
+        for x in range(x1, x2):
+            for y in range(y1, y2):
+                for side in (NORTH, EAST, SOUTH, WEST):
+                    door = self.doors.door_on(x, y, z, side)
+                    if door in self.doors.doors:
+                        self._update_door(door)
+                    elif door in self._door_rooms:
+                        self.door_removed(*door)
+    
+    
+    def squares_changed(self, x1, y1, x2, y2, z):
+        "Re-examines the doors around squares with x1 <= x < x2, y1 <= y < y2."
+        for door in self.doors.doors_in_rect(x1, y1, x2, y2, z):
+            self._update_door(door)
+    
+    
+    def neighbours(self, room):
+        "Returns a dict of {room: set of doors} for the rooms joined to room."
+        return dict(self._edges.get(room, {}))
+    
+    
+    def doors_between(self, a, b):
+        "Returns the set of doors joining rooms a and b."
+        return set(self._edges.get(a, {}).get(b, ()))
+    
+    
+    def reachable(self, room):
+        "Returns the set of rooms (maybe including OUTSIDE) reachable from room."
+        seen = set([room])
+        stack = [room]
+        while stack:
+            for other in self._edges.get(stack.pop(), ()):
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        return seen
+    
+    
+    def connected(self, a, b):
+        "Returns True if you can get from room a to room b."
+        return b in self.reachable(a)
@@ -24,14 +24,51 @@ class Item(object):
         self.model = model or self.name
         self.occupies = occupies
         self.shape = shape
+        # Work out the footprint for each rotation once, up front
+        self.footprints = [Footprint(shape, rot) for rot in range(4)]
+    
+    def footprint(self, rot):
+        "Returns the Footprint for rotation rot (number of 90deg turns anticlockwise)"
+        return self.footprints[rot % 4]
     
     def size(self):
         "Returns the size of this item's bounding box"
-        x1, y1 = self.shape[0]
-        for x, y in self.shape:
-            if x > x1:
-                x1 = x
-            if y > y1:
-                y1 = y
-        return x1+1, y1+1
+        return self.footprints[0].size
+
+
+class Footprint(object):
+    """
+    An Item's shape turned through rot * 90 degrees anticlockwise, and moved
+    back so it again only has positive entries with tiles on both zero lines.
+    
+    'offsets' is the rotated shape, 'size' its bounding box, and 'bitmap' the
+    same squares packed into an int, with bit (dy * width + dx) set for each
+    one. 'shift' is how far the shape moved back after rotating about the
+    origin, which is where a model turned by the same angle needs to go.
+    """
+    
+    __slots__ = ("rotation", "offsets", "size", "bitmap", "shift")
+    
+    def __init__(self, shape, rot):
+        self.rotation = rot
+        offsets = list(shape)
+        for i in range(rot):
+            # Square (x, y) spans x..x+1, so it lands on square (-y-1, x)
+            offsets = [(-y-1, x) for x, y in offsets]
+        sx = -min(x for x, y in offsets)
+        sy = -min(y for x, y in offsets)
+        self.offsets = tuple((x+sx, y+sy) for x, y in offsets)
+        self.shift = (sx, sy)
+        self.size = (
+            max(x for x, y in self.offsets) + 1,
+            max(y for x, y in self.offsets) + 1,
+        )
+        self.bitmap = 0
+        for x, y in self.offsets:
+            self.bitmap |= 1 << (y * self.size[0] + x)
+    
+    def covers(self, dx, dy):
+        "Returns True if the square at dx, dy (relative to the origin) is covered"
+        w, h = self.size
+        return 0 <= dx < w and 0 <= dy < h and bool(self.bitmap >> (dy * w + dx) & 1)
 
@@ -1,144 +1,888 @@
 
-class LocDict(object):
+from array import array
+from collections import OrderedDict
+
+from world.quadtree import QuadTree
+from world.spatial import PointIndex
+from world.constants import NORTH, EAST, SOUTH, WEST
+
+
+def subtract_rect(rects, x1, y1, x2, y2, z):
+    """
+    Returns a copy of the list of (x1, y1, x2, y2, z) rectangles with the
+    given rectangle cut out of them, splitting any it partly overlaps into
+    up to four pieces. Order is otherwise preserved.
+    """
+    result = []
+    for rect in rects:
+        rx1, ry1, rx2, ry2, rz = rect
+        if rz != z or rx1 >= x2 or ry1 >= y2 or rx2 <= x1 or ry2 <= y1:
+            result.append(rect)
+            continue
+        # Full-height strips to the left and right...
+        if rx1 < x1:
+            result.append((rx1, ry1, x1, ry2, z))
+        if rx2 > x2:
+            result.append((x2, ry1, rx2, ry2, z))
+        # ...and whatever's above and below in between.
+        mx1, mx2 = max(rx1, x1), min(rx2, x2)
+        if ry1 < y1:
+            result.append((mx1, ry1, mx2, y1, z))
+        if ry2 > y2:
+            result.append((mx1, y2, mx2, ry2, z))
+    return result
+
+
+
+class SquareSet(object):
     
     """
-    A 'location dictionary', i.e. one that contains items referenced by location
-    (their sets of covered squares). Should probably be a set of quadtrees.
+    The squares covered by one item in a LocDict. It's a list of disjoint
+    (x1, y1, x2, y2, z) rectangles, minus a set of 'holes' punched in them
+    since.
+    
+    A square added on its own starts a new 1x1 rectangle, unless the last
+    rectangle is a column ending just below it, which grows instead (and
+    merges into the rectangle before it if they then line up). So squares
+    added column by column, as range2d gives them, end up as a few
+    rectangles rather than one tuple each.
+    
+    Adding or removing a single square is O(1) (amortised), and iteration
+    order is deterministic: rectangles in the order they were added.
+    """
+    
+    __slots__ = ("rects", "holes", "count")
+    
+    def __init__(self):
+        self.rects = []
+        self.holes = set()
+        self.count = 0
+    
+    
+    def __len__(self):
+        return self.count
+    
+    
+    def __iter__(self):
+        holes = self.holes
+        for x1, y1, x2, y2, z in self.rects:
+            for x in range(x1, x2):
+                for y in range(y1, y2):
+                    if not holes or (x, y, z) not in holes:
+                        yield x, y, z
+    
+    
+    def add(self, x, y, z):
+        "Adds a square, which must not already be in the set."
+        square = (x, y, z)
+        self.count += 1
+        if square in self.holes:
+            self.holes.remove(square)
+            return
+        # Extend the last rectangle if it's a column ending just below us
+        # (the square isn't a hole, so it can't be in any other rectangle)
+        if self.rects:
+            rx1, ry1, rx2, ry2, rz = self.rects[-1]
+            if rz == z and rx1 == x and rx2 == x + 1 and ry2 == y:
+                self.rects[-1] = (x, ry1, x + 1, y + 1, z)
+                self._merge_last()
+                return
+        self.rects.append((x, y, x + 1, y + 1, z))
+        self._merge_last()
+    
+    
+    def _merge_last(self):
+        "Merges the last two rectangles if they sit side by side and line up."
+        if len(self.rects) > 1:
+            px1, py1, px2, py2, pz = self.rects[-2]
+            rx1, ry1, rx2, ry2, rz = self.rects[-1]
+            if pz == rz and py1 == ry1 and py2 == ry2 and px2 == rx1:
+                self.rects[-2:] = [(px1, py1, rx2, py2, pz)]
+    
+    
+    def remove(self, x, y, z):
+        "Removes a square, which must be in the set."
+        self.count -= 1
+        # The square most recently added on its own can just be dropped
+        if self.rects and self.rects[-1] == (x, y, x + 1, y + 1, z):
+            self.rects.pop()
+            return
+        self.holes.add((x, y, z))
+        # If the holes come to outnumber the squares, iterating the
+        # rectangles gets wasteful; build them again from what's left. This
+        # happens at most once per count removals, so removal stays O(1)
+        # amortised.
+        if len(self.holes) > 2 * self.count + 64:
+            squares = list(self)
+            self.rects = []
+            self.holes = set()
+            self.count = 0
+            for square in squares:
+                self.add(*square)
+    
+    
+    def add_rect(self, x1, y1, x2, y2, z):
+        "Adds a rectangle of squares, none of which may already be in the set."
+        rect = (x1, y1, x2, y2, z)
+        # Older rectangles can only overlap this one where they have holes
+        self.rects = subtract_rect(self.rects, *rect)
+        self.holes = set(square for square in self.holes if not _in_rect(square, rect))
+        self.rects.append(rect)
+        self.count += (x2 - x1) * (y2 - y1)
+    
+    
+    def remove_rect(self, x1, y1, x2, y2, z, count):
+        "Removes all squares inside a rectangle; count says how many there are."
+        rect = (x1, y1, x2, y2, z)
+        self.rects = subtract_rect(self.rects, *rect)
+        self.holes = set(square for square in self.holes if not _in_rect(square, rect))
+        self.count -= count
+    
+    
+    def to_rects(self):
+        "Returns the squares as a list of disjoint rectangles."
+        rects = []
+        for rect in self.rects:
+            pieces = [rect]
+            for x, y, z in self.holes:
+                if _in_rect((x, y, z), rect):
+                    pieces = subtract_rect(pieces, x, y, x + 1, y + 1, z)
+            rects.extend(pieces)
+        return rects
+
+
+
+def _in_rect((x, y, z), (x1, y1, x2, y2, rz)):
+    return z == rz and x1 <= x < x2 and y1 <= y < y2
+
+
+
+class ChunkGrid(object):
+    
+    """
+    An unbounded 2D grid of small integers, split into square chunks of
+    SIZE x SIZE cells. A chunk is only allocated when something non-zero is
+    written into it, and is thrown away again once it's back to all zeroes,
+    so memory depends on what's been built rather than how spread out it is.
+    
+    Within a chunk, cells are stored column by column (local x * SIZE + local y).
+    The allocated chunks are indexed by a QuadTree, so region queries only
+    visit chunks that both overlap the region and have something in them.
+    
+    Each chunk also has a generation number, which changes whenever any of
+    its cells does or it's touch()ed (numbers are never reused, even across
+    a chunk being freed), so caches can tell which parts of the grid they
+    depend on.
+    """
+    
+    SHIFT = 6
+    SIZE = 1 << SHIFT
+    MASK = SIZE - 1
+    
+    def __init__(self, typecode="H"):
+        self.typecode = typecode
+        self._chunks = {}
+        self._counts = {}
+        self._index = QuadTree()
+        self._blank = array(typecode, [0]) * (self.SIZE * self.SIZE)
+        self._generations = {}
+        self._changes = 0
+    
+    
+    def get(self, x, y):
+        "Returns the value at x, y (0 if nothing has been set there)."
+        chunk = self._chunks.get((x >> self.SHIFT, y >> self.SHIFT))
+        if chunk is None:
+            return 0
+        return chunk[((x & self.MASK) << self.SHIFT) | (y & self.MASK)]
+    
+    
+    def set(self, x, y, value):
+        "Sets the value at x, y, returning the old value."
+        key = (x >> self.SHIFT, y >> self.SHIFT)
+        index = ((x & self.MASK) << self.SHIFT) | (y & self.MASK)
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            if not value:
+                return 0
+            chunk = self._chunks[key] = self._blank[:]
+            self._counts[key] = 0
+            self._index.insert(*key)
+        old = chunk[index]
+        if old == value:
+            return old
+        chunk[index] = value
+        self._changes += 1
+        self._generations[key] = self._changes
+        if value and not old:
+            self._counts[key] += 1
+        elif old and not value:
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                del self._chunks[key]
+                del self._counts[key]
+                self._index.remove(*key)
+        return old
+    
+    
+    def query_rect(self, x1, y1, x2, y2):
+        """
+        Yields (x, y, value) for every non-zero cell with x1 <= x < x2
+        and y1 <= y < y2.
+        """
+        shift, size = self.SHIFT, self.SIZE
+        for cx, cy in self._index.query(x1 >> shift, y1 >> shift, ((x2 - 1) >> shift) + 1, ((y2 - 1) >> shift) + 1):
+            chunk = self._chunks[cx, cy]
+            base_x, base_y = cx << shift, cy << shift
+            # Work out which part of the chunk is inside the rectangle
+            lx1, lx2 = max(x1 - base_x, 0), min(x2 - base_x, size)
+            ly1, ly2 = max(y1 - base_y, 0), min(y2 - base_y, size)
+            for lx in range(lx1, lx2):
+                start = (lx << shift) + ly1
+                column = chunk[start:start + ly2 - ly1]
+                if column.count(0) != len(column):
+                    for ly, value in enumerate(column, ly1):
+                        if value:
+                            yield base_x + lx, base_y + ly, value
+    
+    
+    def fill_rect(self, x1, y1, x2, y2, value):
+        """
+        Sets every cell with x1 <= x < x2 and y1 <= y < y2 to value, a
+        column slice at a time. Returns a dict of {old value: cell count}
+        for the non-zero values that got overwritten.
+        """
+        replaced = {}
+        if x1 >= x2 or y1 >= y2:
+            return replaced
+        shift, size = self.SHIFT, self.SIZE
+        cx1, cy1 = x1 >> shift, y1 >> shift
+        cx2, cy2 = ((x2 - 1) >> shift) + 1, ((y2 - 1) >> shift) + 1
+        if value:
+            keys = [(cx, cy) for cx in range(cx1, cx2) for cy in range(cy1, cy2)]
+        else:
+            # Clearing never needs to touch unallocated chunks
+            keys = list(self._index.query(cx1, cy1, cx2, cy2))
+        for key in keys:
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                chunk = self._chunks[key] = self._blank[:]
+                self._counts[key] = 0
+                self._index.insert(*key)
+            base_x, base_y = key[0] << shift, key[1] << shift
+            lx1, lx2 = max(x1 - base_x, 0), min(x2 - base_x, size)
+            ly1, ly2 = max(y1 - base_y, 0), min(y2 - base_y, size)
+            height = ly2 - ly1
+            fill = array(self.typecode, [value]) * height
+            for lx in range(lx1, lx2):
+                start = (lx << shift) + ly1
+                column = chunk[start:start + height]
+                zeros = column.count(0)
+                if zeros != height:
+                    for old in set(column):
+                        if old:
+                            replaced[old] = replaced.get(old, 0) + column.count(old)
+                chunk[start:start + height] = fill
+                if value:
+                    self._counts[key] += zeros
+                else:
+                    self._counts[key] -= height - zeros
+            self._changes += 1
+            self._generations[key] = self._changes
+            if not self._counts[key]:
+                del self._chunks[key]
+                del self._counts[key]
+                self._index.remove(*key)
+        return replaced
+    
+    
+    def chunks(self):
+        "Returns the (cx, cy) keys of all allocated chunks."
+        return self._chunks.keys()
+    
+    
+    def generation(self, cx, cy):
+        "Returns the generation number of chunk (cx, cy) (0 if never touched)."
+        return self._generations.get((cx, cy), 0)
+    
+    
+    def touch(self, cx, cy):
+        """
+        Gives chunk (cx, cy) a new generation number without changing any
+        cells, for when something the grid summarises has changed under it.
+        """
+        self._changes += 1
+        self._generations[cx, cy] = self._changes
+    
+    
+    def chunk(self, cx, cy):
+        "Returns the typed array for chunk (cx, cy), or None if it's empty."
+        return self._chunks.get((cx, cy))
+    
+    
+    def bounds(self):
+        """
+        Returns (x1, y1, x2, y2) covering every allocated chunk (so every
+        non-zero cell), or None if there aren't any.
+        """
+        if not self._chunks:
+            return None
+        cxs = [cx for cx, cy in self._chunks]
+        cys = [cy for cx, cy in self._chunks]
+        return (
+            min(cxs) << self.SHIFT,
+            min(cys) << self.SHIFT,
+            (max(cxs) + 1) << self.SHIFT,
+            (max(cys) + 1) << self.SHIFT,
+        )
+    
+    
+    def __len__(self):
+        "Returns the number of non-zero cells."
+        return sum(self._counts.values())
+
+
+
+class DirtyNotifier(object):
+    
+    """
+    Mixin for things that tell listeners which region just changed. Each
+    listener is called as listener(x1, y1, x2, y2, z) for the rectangle
+    x1 <= x < x2, y1 <= y < y2 on level z, straight after the change (on
+    whichever thread made it).
+    """
+    
+    def listen(self, listener):
+        "Registers a callable to hear about changed regions."
+        self._listeners.append(listener)
+    
+    
+    def unlisten(self, listener):
+        self._listeners.remove(listener)
+    
+    
+    def _dirty(self, x1, y1, x2, y2, z):
+        for listener in self._listeners:
+            listener(x1, y1, x2, y2, z)
+
+
+
+class BaseLocDict(DirtyNotifier):
+    
     """
+    The parts LocDict and ItemDict share: a table giving every item stored
+    a small integer ID (so grids and typed arrays can refer to items
+    compactly, with 0 meaning nothing), a version number for each item, and
+    the listeners (see DirtyNotifier).
+    
+    Subclasses keep each item's squares in _items, and provide add, clear,
+    get, level, query_rect, rects_for_item and _coords.
+    """
+    
+    MAX_ID = 65535
     
     def __init__(self):
         
-        self._grids = {}
         self._items = {}
-        self._sizes = {}
+        self._ids = {}
+        self._owners = [None]
+        self._free_ids = []
+        self._versions = {}
+        self._changes = 0
+        self._listeners = []
+    
+    
+    def _id_for(self, item):
+        "Returns the ID for item, allocating one if it hasn't got one."
+        try:
+            return self._ids[item]
+        except KeyError:
+            if self._free_ids:
+                id = self._free_ids.pop()
+                self._owners[id] = item
+            else:
+                id = len(self._owners)
+                if id > self.MAX_ID:
+                    raise ValueError("A %s can only hold %i different items." % (self.__class__.__name__, self.MAX_ID))
+                self._owners.append(item)
+            self._ids[item] = id
+            return id
+    
+    
+    def _release_id(self, item):
+        "Frees the ID of an item that no longer covers any squares."
+        id = self._ids.pop(item)
+        self._owners[id] = None
+        self._free_ids.append(id)
+        self._versions.pop(item, None)
+    
+    
+    def _changed(self, item):
+        "Gives item a new version number; they're never reused."
+        self._changes += 1
+        self._versions[item] = self._changes
+    
+    
+    def version(self, item):
+        "Returns the version number of item's squares (0 if it has none)."
+        return self._versions.get(item, 0)
+    
+    
+    def query_radius(self, x, y, r, z):
+        """
+        Yields (x, y, z, item) for every filled square on level z within
+        distance r of (x, y).
+        """
+        r2 = r * r
+        reach = int(r)
+        for cx, cy, cz, item in self.query_rect(x - reach, y - reach, x + reach + 1, y + reach + 1, z):
+            if (cx - x) ** 2 + (cy - y) ** 2 <= r2:
+                yield cx, cy, cz, item
+    
+    
+    def __iter__(self):
+        return iter(self._items)
+    
+    
+    def items(self):
+        "Returns a list of (item, list of coords) pairs."
+        return [(item, list(self._coords(item))) for item in self._items]
+    
+    
+    def coords_for_item(self, item):
+        if item not in self._items:
+            raise KeyError(item)
+        return self._coords(item)
+    
+    
+    def all_coords(self):
+        for item in self._items:
+            for coord in self._coords(item):
+                yield coord
+
+
+
+class LocDict(BaseLocDict):
+    
+    """
+    A 'location dictionary', i.e. one that contains items referenced by location
+    (their sets of covered squares).
+    
+    Each z-level is a ChunkGrid of small integer IDs; ID 0 means the cell is
+    empty, and any other ID indexes into the ID->item table. The chunks are
+    quadtree-indexed, so query_rect and query_radius only look at the parts
+    of the level that overlap the query.
     
+    Each item's squares are remembered in a SquareSet, mostly as run-length
+    rectangles rather than one tuple per square, which lets squares move
+    from one item to another in constant time.
     
-    def grow_to_size(self, width, height, z):
-        "Increases the size of the items grid to the given size."
+    Every item also has a version number, which changes whenever it gains
+    or loses squares, so anything derived from an item's shape can tell
+    when it needs recalculating. Listeners (see DirtyNotifier) are told
+    which squares changed.
+    """
+    
+    TYPECODE = "H"
+    
+    def __init__(self):
         
-        # Make sure there's a level at z
-        if z not in self._grids:
-            self._grids[z] = []
-            self._sizes[z] = [0, 0]
-        # Extend it in the x direction
-        if width > self._sizes[z][0]:
-            self._grids[z].extend([[None] * max(height, self._sizes[z][1]) for i in range(width - len(self._grids[z]))])
-            self._sizes[z][0] = width
-        # And the y direction
-        if height > self._sizes[z][1]:
-            for column in self._grids[z]:
-                column.extend([None] * (height - len(column)))
-            self._sizes[z][1] = height
+        BaseLocDict.__init__(self)
+        self._grids = {}
     
     
     def add(self, x, y, z, item):
         "Adds an item to the LocDict at the given coords."
-        # Make sure we're big enough.
-        self.grow_to_size(x+1, y+1, z)
+        # Make sure there's a level at z
+        if z not in self._grids:
+            self._grids[z] = ChunkGrid(self.TYPECODE)
         # Remove anything previously there
         self.clear(x, y, z)
-        # Add it to the grid and list of items.
-        self._grids[z][x][y] = item
+        # Add it to the grid and the item's squares.
+        self._grids[z].set(x, y, self._id_for(item))
         if item not in self._items:
-            self._items[item] = [(x, y, z)]
-        else:
-            self._items[item].append((x, y, z))
+            self._items[item] = SquareSet()
+        self._items[item].add(x, y, z)
+        self._changed(item)
+        self._dirty(x, y, x + 1, y + 1, z)
+    
+    
+    def fill_rect(self, x1, y1, x2, y2, z, item):
+        """
+        Fills every square with x1 <= x < x2 and y1 <= y < y2 on level z
+        with item, replacing whatever was there, in one operation.
+        """
+        if x1 >= x2 or y1 >= y2:
+            return
+        if z not in self._grids:
+            self._grids[z] = ChunkGrid(self.TYPECODE)
+        replaced = self._grids[z].fill_rect(x1, y1, x2, y2, self._id_for(item))
+        # Cut the rectangle out of whatever was previously there
+        for id, count in replaced.items():
+            old_item = self._owners[id]
+            squares = self._items[old_item]
+            squares.remove_rect(x1, y1, x2, y2, z, count)
+            if not squares and old_item is not item:
+                del self._items[old_item]
+                self._release_id(old_item)
+            else:
+                self._changed(old_item)
+        if item not in self._items:
+            self._items[item] = SquareSet()
+        self._items[item].add_rect(x1, y1, x2, y2, z)
+        self._changed(item)
+        self._dirty(x1, y1, x2, y2, z)
     
     
     def clear(self, x, y, z):
         "Removes whatever was at x, y, z."
-        item = self._grids[z][x][y]
+        item = self.get(x, y, z)
         if item is not None:
-            self._grids[z][x][y] = None
-            self._items[item].remove((x, y, z))
-            if not self._items[item]:
+            self._grids[z].set(x, y, 0)
+            squares = self._items[item]
+            squares.remove(x, y, z)
+            if not squares:
                 del self._items[item]
+                self._release_id(item)
+            else:
+                self._changed(item)
+            self._dirty(x, y, x + 1, y + 1, z)
     
     
     def get(self, x, y, z):
         "Returns the item at (x, y, z)"
         try:
-            return self._grids[z][x][y]
-        except IndexError:
+            return self._owners[self._grids[z].get(x, y)]
+        except KeyError:
             return None
     
     
-    def __iter__(self):
-        return iter(self._items)
+    def level(self, z):
+        """
+        Returns the ChunkGrid of item IDs for level z (or None). Two squares
+        are in the same item exactly when they have the same non-zero ID,
+        which is cheaper to compare in bulk than the items themselves.
+        """
+        return self._grids.get(z)
     
     
-    def items(self):
-        return self._items.items()
+    def levels(self):
+        "Returns the z of every level that has a grid."
+        return self._grids.keys()
     
     
-    def coords_for_item(self, item):
-        return self._items[item]
+    def query_rect(self, x1, y1, x2, y2, z):
+        """
+        Yields (x, y, z, item) for every filled square with x1 <= x < x2
+        and y1 <= y < y2 on level z.
+        """
+        if z not in self._grids:
+            return
+        owners = self._owners
+        for x, y, id in self._grids[z].query_rect(x1, y1, x2, y2):
+            yield x, y, z, owners[id]
     
     
-    def all_coords(self):
-        for item, coords in self._items.items():
-            for coord in coords:
-                yield coord
+    def _coords(self, item):
+        "Yields the coords of every square covered by item."
+        return iter(self._items[item])
+    
+    
+    def rects_for_item(self, item):
+        "Returns the item's squares as a list of (x1, y1, x2, y2, z) rectangles."
+        return self._items[item].to_rects()
 
 
 
-class ItemDict(LocDict):
+class ItemDict(BaseLocDict):
     
     """
-    A subclass of LocDict that tracks items - things with predefined floor
-    patterns. Each Item has a .shape attribute which gives which squares
-    it occupies relative to the origin and rotation.
+    A sibling of LocDict that tracks items - things with predefined floor
+    patterns. Each Item has precomputed footprints which give which squares
+    it occupies relative to the origin for each rotation.
+    
+    An Item is a type of thing (a bench, a departures board) and can be
+    placed any number of times. Each placement gets an integer ID, and is
+    stored as a row across parallel typed arrays of item type ID, x, y, z
+    and rotation, so thousands of benches share one Item.
+    
+    More than one placement can share a square, so rather than the typed ID
+    grid the squares are kept as a dict of (x, y, z) -> set of placement IDs.
+    Alongside that, each level has a ChunkGrid holding the OR of the
+    'occupies' masks of everything on each square, which is what can_place
+    checks against, and there's a PointIndex of placement centres for each
+    Item.model, for nearest() and within() queries.
+    
+    An Item's version number changes whenever one of its placements is
+    added or removed, and so do the generations of the mask grid's chunks
+    under it, even when the masks themselves stay the same.
     """
     
     def __init__(self):
         
-        LocDict.__init__(self)
+        BaseLocDict.__init__(self)
+        self._cells = {}
+        self._masks = {}
+        # The placement table; a type ID of 0 marks a free row
+        self._types = array("H")
+        self._xs = array("i")
+        self._ys = array("i")
+        self._zs = array("i")
+        self._rots = array("B")
+        self._free_rows = []
+        self._by_model = {}
+    
+    
+    def footprint(self, item, x, y, z, rot):
+        "Returns the list of squares item would cover if placed at x, y, z."
+        return [(dx+x, dy+y, z) for dx, dy in item.footprint(rot).offsets]
     
     
     def add(self, x, y, z, rot, item):
         """
-        Adds the item at x,y with rotation rot (one of 0, 1, 2, 3 - number
-        of 90deg rotations anticlockwise.)
+        Places the item at x,y with rotation rot (one of 0, 1, 2, 3 - number
+        of 90deg rotations anticlockwise.) Returns the new placement's ID.
+        """
+        rot %= 4
+        type_id = self._id_for(item)
+        # Write the placement row
+        if self._free_rows:
+            placement = self._free_rows.pop()
+            self._types[placement] = type_id
+            self._xs[placement] = x
+            self._ys[placement] = y
+            self._zs[placement] = z
+            self._rots[placement] = rot
+        else:
+            placement = len(self._types)
+            self._types.append(type_id)
+            self._xs.append(x)
+            self._ys.append(y)
+            self._zs.append(z)
+            self._rots.append(rot)
+        self._items.setdefault(item, set()).add(placement)
+        self._changed(item)
+        # Add it to the squares
+        if z not in self._masks:
+            self._masks[z] = ChunkGrid("B")
+        masks = self._masks[z]
+        chunks = set()
+        for square in self.footprint(item, x, y, z, rot):
+            # Make sure it's a set, and stick it into the set
+            self._cells.setdefault(square, set()).add(placement)
+            masks.set(square[0], square[1], masks.get(square[0], square[1]) | item.occupies)
+            chunks.add((square[0] >> masks.SHIFT, square[1] >> masks.SHIFT))
+        # The masks may not have changed (if the squares were already
+        # occupied), but the placements on them have
+        for cx, cy in chunks:
+            masks.touch(cx, cy)
+        # Index its centre under its model
+        if item.model not in self._by_model:
+            self._by_model[item.model] = PointIndex()
+        w, h = item.footprint(rot).size
+        self._by_model[item.model].add(placement, x + w / 2.0, y + h / 2.0, z)
+        self._dirty(x, y, x + w, y + h, z)
+        return placement
+    
+    
+    def remove(self, placement):
+        """
+        Removes a placement from the ItemDict.
+        """
+        item, x, y, z, rot = self.placement(placement)
+        masks = self._masks[z]
+        chunks = set()
+        for square in self.footprint(item, x, y, z, rot):
+            self._cells[square].remove(placement)
+            if not self._cells[square]:
+                del self._cells[square]
+            masks.set(square[0], square[1], self._mask_of(square))
+            chunks.add((square[0] >> masks.SHIFT, square[1] >> masks.SHIFT))
+        for cx, cy in chunks:
+            masks.touch(cx, cy)
+        self._items[item].remove(placement)
+        if not self._items[item]:
+            del self._items[item]
+            self._release_id(item)
+        else:
+            self._changed(item)
+        self._by_model[item.model].remove(placement)
+        if not self._by_model[item.model]:
+            del self._by_model[item.model]
+        self._types[placement] = 0
+        self._free_rows.append(placement)
+        w, h = item.footprint(rot).size
+        self._dirty(x, y, x + w, y + h, z)
+    
+    
+    def move(self, placement, x, y, z, rot):
+        "Moves a placement, returning its (possibly different) new ID."
+        item = self.placement(placement)[0]
+        self.remove(placement)
+        return self.add(x, y, z, rot, item)
+    
+    
+    def placement(self, placement):
+        "Returns (item, x, y, z, rot) for a placement ID."
+        type_id = self._types[placement]
+        if not type_id:
+            raise KeyError(placement)
+        return (
+            self._owners[type_id],
+            self._xs[placement],
+            self._ys[placement],
+            self._zs[placement],
+            self._rots[placement],
+        )
+    
+    
+    def placements(self, item=None):
+        "Yields the IDs of all placements (or just those of item)."
+        if item is not None:
+            for placement in sorted(self._items.get(item, ())):
+                yield placement
+        else:
+            for placement, type_id in enumerate(self._types):
+                if type_id:
+                    yield placement
+    
+    
+    def placements_at(self, x, y, z):
+        "Returns the set of placement IDs covering x, y, z (maybe empty)."
+        return self._cells.get((x, y, z), set())
+    
+    
+    def nearest(self, model, x, y, z, k=1, max_distance=None):
+        """
+        Returns up to k (distance, placement ID) pairs for the placements
+        of items with the given model nearest to x, y on level z, measured
+        to the centre of each placement's footprint. Closest first.
         """
-        # Remove it if it's already here
-        if item in self._items:
-            self.remove(item)
-        # First, grow to fit it
-        w, h = item.size()
-        if rot % 2:
-            w, h = h, w
-        self.grow_to_size(x+w, y+h, z)
-        # Then, add it to the squares
-        squares = []
-        for dx, dy in item.shape:
-            nx, ny = dx+x, dy+y
-            squares.append((nx, ny, z))
-            # Make sure it's a set
-            if self._grids[z][nx][ny] is None:
-                self._grids[z][nx][ny] = set()
-            # Stick it into the set
-            self._grids[z][nx][ny].add(item)
-        self._items = {item: squares}
-        item.origin = (x, y, z)
-        item.rotation = 90.0 * rot
+        if model not in self._by_model:
+            return []
+        return self._by_model[model].nearest(x, y, z, k, max_distance)
     
     
-    def remove(self, item):
+    def within(self, model, x, y, z, r):
         """
-        Removes an item from the ItemDict.
+        Returns (distance, placement ID) pairs for the placements of items
+        with the given model whose centres are within r of x, y on level z.
         """
-        for x, y, z in self._items[item]:
-            self._grids[z][x][y].remove(item)
-        del self._items[item]
+        if model not in self._by_model:
+            return []
+        return self._by_model[model].within(x, y, z, r)
+    
+    
+    def _mask_of(self, square, exclude=None):
+        "Works out the occupancy mask of a square from the placements on it."
+        mask = 0
+        for placement in self._cells.get(square, ()):
+            if placement != exclude:
+                mask |= self._owners[self._types[placement]].occupies
+        return mask
+    
+    
+    def level(self, z):
+        "Returns the ChunkGrid of occupancy masks for level z (or None)."
+        return self._masks.get(z)
+    
+    
+    def occupancy(self, x, y, z):
+        "Returns the OR of the occupancy masks of all items at x, y, z."
+        try:
+            return self._masks[z].get(x, y)
+        except KeyError:
+            return 0
+    
+    
+    def can_place(self, item, x, y, z, rot, ignore=None):
+        """
+        Returns True if item could go at x, y, z with rotation rot without
+        sharing any part of a square (floor, lower, upper) with another item.
+        Pass a placement ID as ignore to leave it out of the check, which
+        is what you want when previewing a move.
+        """
+        masks = self._masks.get(z)
+        if masks is None:
+            return True
+        occupies = item.occupies
+        for sx, sy, sz in self.footprint(item, x, y, z, rot):
+            if masks.get(sx, sy) & occupies:
+                # Might just be the placement being moved
+                if ignore not in self._cells[sx, sy, sz] or self._mask_of((sx, sy, sz), ignore) & occupies:
+                    return False
+        return True
+    
+    
+    def clear(self, x, y, z):
+        "Removes all placements covering x, y, z."
+        for placement in list(self.placements_at(x, y, z)):
+            self.remove(placement)
+    
+    
+    def get(self, x, y, z):
+        "Returns the set of items at (x, y, z), or None."
+        placements = self._cells.get((x, y, z))
+        if placements:
+            return set(self._owners[self._types[placement]] for placement in placements)
+        return None
+    
+    
+    def query_rect(self, x1, y1, x2, y2, z):
+        """
+        Yields (x, y, z, item) for every item on every square with
+        x1 <= x < x2 and y1 <= y < y2 on level z (once per item per square).
+        """
+        if (x2 - x1) * (y2 - y1) <= len(self._cells):
+            squares = [
+                (x, y, z)
+                for x in range(x1, x2)
+                for y in range(y1, y2)
+                if (x, y, z) in self._cells
+            ]
+        else:
+            squares = [
+                square
+                for square in self._cells
+                if square[2] == z and x1 <= square[0] < x2 and y1 <= square[1] < y2
+            ]
+        for square in squares:
+            for item in self.get(*square):
+                yield square + (item,)
+    
+    
+    def rects_for_item(self, item):
+        "Returns the squares covered by item's placements as (x1, y1, x2, y2, z) rectangles."
+        squares = SquareSet()
+        for x, y, z in sorted(set(self.coords_for_item(item))):
+            squares.add(x, y, z)
+        return squares.to_rects()
+    
+    
+    def _coords(self, item):
+        for placement in self.placements(item):
+            x, y, z, rot = self.placement(placement)[1:]
+            for square in self.footprint(item, x, y, z, rot):
+                yield square
 
 
     
-class DoorDict(object):
+class DoorDict(DirtyNotifier):
     
-    "Stores a set of 'doors' (i.e. wall segments - (1,2) to (2,2))"
+    """
+    Stores a set of 'doors' (i.e. wall segments - (1,2) to (2,2))
+    
+    As well as the set, each level has a ChunkGrid of per-square masks of
+    which sides (NORTH/EAST/SOUTH/WEST) have a door in them, so a square's
+    doors can be found with a single open_sides() lookup. Listeners (see
+    DirtyNotifier) are told about the two squares either side of any door
+    added or removed.
+    """
     
     def __init__(self):
         self.doors = set()
+        self._sides = {}
+        self._listeners = []
     
     
     def normalise(self, x, y, x2, y2, z):
@@ -151,18 +895,84 @@ class DoorDict(object):
         return x, y, x2, y2, z
     
     
+    def squares_for(self, x, y, x2, y2, z):
+        """
+        Returns ((x, y, side), (x, y, side)) for the two squares either side
+        of a (normalised) door, and the side of each square it's on.
+        """
+        if x == x2 and y2 == y + 1:
+            return (x - 1, y, EAST), (x, y, WEST)
+        elif y == y2 and x2 == x + 1:
+            return (x, y - 1, NORTH), (x, y, SOUTH)
+        raise ValueError("Doors must be exactly one square long.")
+    
+    
     def __contains__(self, (x, y, x2, y2, z)):
         return self.normalise(x, y, x2, y2, z) in self.doors
     
     
     def add(self, x, y, x2, y2, z):
-        self.doors.add(self.normalise(x, y, x2, y2, z))
+        door = self.normalise(x, y, x2, y2, z)
+        squares = self.squares_for(*door)
+        self.doors.add(door)
+        if z not in self._sides:
+            self._sides[z] = ChunkGrid("B")
+        grid = self._sides[z]
+        for sx, sy, side in squares:
+            grid.set(sx, sy, grid.get(sx, sy) | side)
+        self._dirty(squares[0][0], squares[0][1], door[0] + 1, door[1] + 1, z)
     
     
     def remove(self, x, y, x2, y2, z):
-        self.doors.remove(self.normalise(x, y, x2, y2, z))
+        door = self.normalise(x, y, x2, y2, z)
+        self.doors.remove(door)
+        grid = self._sides[z]
+        squares = self.squares_for(*door)
+        for sx, sy, side in squares:
+            grid.set(sx, sy, grid.get(sx, sy) & ~side)
+        self._dirty(squares[0][0], squares[0][1], door[0] + 1, door[1] + 1, z)
+    
+    
+    def open_sides(self, x, y, z):
+        "Returns the mask of sides of square x, y, z that have a door in them."
+        try:
+            return self._sides[z].get(x, y)
+        except KeyError:
+            return 0
+    
+    
+    def level(self, z):
+        "Returns the ChunkGrid of door side masks for level z (or None)."
+        return self._sides.get(z)
+    
+    
+    def door_on(self, x, y, z, side):
+        "Returns the (normalised) door tuple for one side of a square."
+        if side == WEST:
+            return (x, y, x, y + 1, z)
+        elif side == EAST:
+            return (x + 1, y, x + 1, y + 1, z)
+        elif side == SOUTH:
+            return (x, y, x + 1, y, z)
+        elif side == NORTH:
+            return (x, y + 1, x + 1, y + 1, z)
+        raise ValueError("Unknown side %r" % side)
+    
+    
+    def doors_in_rect(self, x1, y1, x2, y2, z):
+        """
+        Returns the set of doors on any side of any square with
+        x1 <= x < x2 and y1 <= y < y2 on level z.
+        """
+        doors = set()
+        if z in self._sides:
+            for x, y, mask in self._sides[z].query_rect(x1, y1, x2, y2):
+                for side in (NORTH, EAST, SOUTH, WEST):
+                    if mask & side:
+                        doors.add(self.door_on(x, y, z, side))
+        return doors
     
     
     def __iter__(self):
         return iter(self.doors)
-    
\ No newline at end of file
+    
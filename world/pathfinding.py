@@ -0,0 +1,373 @@
+"""
+Pathfinding over the World's rooms and doors.
+"""
+
+import heapq
+from array import array
+from collections import OrderedDict
+
+from world.constants import NORTH, EAST, SOUTH, WEST
+from world.locdict import ChunkGrid
+
+# Move costs are kept as integers (a diagonal is 14/10 of a straight step),
+# so equal-cost routes compare exactly equal and the heap tie-break works.
+STRAIGHT_COST = 10
+DIAGONAL_COST = 14
+
+# (dx, dy, side of the square we're leaving) for the straight moves
+STRAIGHT = ((0, 1, NORTH), (1, 0, EAST), (0, -1, SOUTH), (-1, 0, WEST))
+DIAGONAL = ((1, 1), (1, -1), (-1, -1), (-1, 1))
+
+
+def octile(x, y, x2, y2):
+    "Cost between two squares when diagonal moves are allowed."
+    dx, dy = abs(x2 - x), abs(y2 - y)
+    return STRAIGHT_COST * (dx + dy) + (DIAGONAL_COST - 2 * STRAIGHT_COST) * min(dx, dy)
+
+
+def path_cost(path):
+    "Returns the cost of a path of squares, in the same units as octile()."
+    total = 0
+    for (x, y, z), (x2, y2, z2) in zip(path, path[1:]):
+        total += DIAGONAL_COST if x != x2 and y != y2 else STRAIGHT_COST
+    return total
+
+
+class Pathfinder(object):
+    
+    """
+    A* search over the squares of a World. Any square in a room is walkable;
+    you can step between squares of the same room freely (diagonally too,
+    as long as both squares you cut past are also in that room), but you
+    can only cross from one room to another, or to the outside, through a
+    door.
+    
+    The per-square scratch buffers (cost so far, parent, and which search
+    last touched/closed each square) are allocated once for the whole
+    world and reused, using a search counter instead of clearing them, so
+    a search doesn't allocate anything per node beyond its heap entries.
+    """
+    
+    def __init__(self, world):
+        self.world = world
+        self.width, self.height = world.size
+        self._costs = None
+        self._search = 0
+    
+    
+    def _allocate(self):
+        size = self.width * self.height
+        self._costs = array("l", [0]) * size
+        self._parents = array("i", [-1]) * size
+        self._seen = array("I", [0]) * size
+        self._closed = array("I", [0]) * size
+    
+    
+    def find_path(self, start, goal, limit=None, same_room=False):
+        """
+        Returns the list of (x, y, z) squares from start to goal inclusive,
+        or None if there's no way through (or more than limit squares had
+        to be expanded to find out). Both must be on the same level.
+        If same_room is set, the path may not leave the start's room.
+        """
+        (sx, sy, z), (gx, gy, gz) = start, goal
+        if z != gz:
+            raise ValueError("Start and goal must be on the same level.")
+        grid = self.world.rooms.level(z)
+        if grid is None or not grid.get(sx, sy) or not grid.get(gx, gy):
+            return None
+        if same_room and grid.get(sx, sy) != grid.get(gx, gy):
+            return None
+        width, height = self.width, self.height
+        if not (0 <= sx < width and 0 <= sy < height and 0 <= gx < width and 0 <= gy < height):
+            return None
+        if self._costs is None:
+            self._allocate()
+        # Bump the search counter rather than clearing the buffers
+        self._search += 1
+        if self._search > 0xffffffff:
+            self._allocate()
+            self._search = 1
+        search = self._search
+        costs, parents, seen, closed = self._costs, self._parents, self._seen, self._closed
+        open_sides = self.world.doors.open_sides
+        start_index, goal_index = sx * height + sy, gx * height + gy
+        costs[start_index] = 0
+        parents[start_index] = -1
+        seen[start_index] = search
+        # Heap entries are (estimated total, estimated remaining, square);
+        # ties go to whichever is closer to the goal.
+        h = octile(sx, sy, gx, gy)
+        heap = [(h, h, start_index)]
+        expanded = 0
+        while heap:
+            f, h, index = heapq.heappop(heap)
+            if closed[index] == search:
+                continue
+            if index == goal_index:
+                return self._walk_back(index, z)
+            closed[index] = search
+            expanded += 1
+            if limit is not None and expanded > limit:
+                return None
+            x, y = divmod(index, height)
+            room = grid.get(x, y)
+            cost = costs[index]
+            doors = open_sides(x, y, z)
+            # Straight moves: same room, or through a door
+            for dx, dy, side in STRAIGHT:
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx < width and 0 <= ny < height):
+                    continue
+                other = grid.get(nx, ny)
+                if not other or (other != room and (same_room or not doors & side)):
+                    continue
+                self._relax(heap, index, nx * height + ny, nx, ny, cost + STRAIGHT_COST, gx, gy, search)
+            # Diagonal moves, only within a room and not cutting corners
+            for dx, dy in DIAGONAL:
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx < width and 0 <= ny < height):
+                    continue
+                if grid.get(nx, ny) != room or grid.get(nx, y) != room or grid.get(x, ny) != room:
+                    continue
+                self._relax(heap, index, nx * height + ny, nx, ny, cost + DIAGONAL_COST, gx, gy, search)
+        return None
+    
+    
+    def _relax(self, heap, parent, index, x, y, cost, gx, gy, search):
+        "Records a new route to index if it's the first or the cheapest."
+        if self._closed[index] == search:
+            return
+        if self._seen[index] != search or cost < self._costs[index]:
+            self._seen[index] = search
+            self._costs[index] = cost
+            self._parents[index] = parent
+            h = octile(x, y, gx, gy)
+            heapq.heappush(heap, (cost + h, h, index))
+    
+    
+    def _walk_back(self, index, z):
+        "Follows the parent pointers back from index to build the path."
+        height, parents = self.height, self._parents
+        path = []
+        while index != -1:
+            x, y = divmod(index, height)
+            path.append((x, y, z))
+            index = parents[index]
+        path.reverse()
+        return path
+
+
+
+class HierarchicalPathfinder(object):
+    
+    """
+    Plans long routes in two stages. First it searches an abstract graph
+    whose nodes are the squares either side of each door (plus the start
+    and goal), with edges across each door and between every pair of
+    door squares in the same room; then it fills in the legs inside each
+    room with a Pathfinder that isn't allowed to leave that room.
+    
+    Legs are worked out lazily: an edge across a room goes on the heap
+    with its octile distance, which is never more than the real cost, and
+    the real leg is only searched for when that edge comes off the heap.
+    In open rooms the estimate is exact, so only the legs on the final
+    route ever get searched, however many doors the rooms have.
+    
+    Door-to-door legs are cached per room, and the cache is thrown away
+    only when that room's squares change (going by LocDict.version), so
+    building elsewhere doesn't cost anything here.
+    """
+    
+    def __init__(self, world):
+        self.world = world
+        self.local = Pathfinder(world)
+        # room -> (version, {(from square, to square): (cost, path) or None})
+        self._legs = {}
+    
+    
+    def _leg(self, room, a, b, cache=True):
+        """
+        Returns (cost, path) for getting from a to b without leaving room,
+        or None. Only door-to-door legs are worth caching; the ones from
+        the start or to the goal are one-offs.
+        """
+        if not cache:
+            path = self.local.find_path(a, b, same_room=True)
+            return path and (path_cost(path), path)
+        version = self.world.rooms.version(room)
+        cached = self._legs.get(room)
+        if cached is None or cached[0] != version:
+            cached = self._legs[room] = (version, {})
+        legs = cached[1]
+        if (a, b) not in legs:
+            path = self.local.find_path(a, b, same_room=True)
+            legs[a, b] = path and (path_cost(path), path)
+            legs[b, a] = path and (legs[a, b][0], path[::-1])
+        return legs[a, b]
+    
+    
+    def entrances(self, room):
+        """
+        Returns a list of (square, far square) pairs for each door out of
+        room: the square on this side, and the one on the other (None if
+        the door leads outside, where you can't walk).
+        """
+        result = []
+        for other, doors in self.world.graph.neighbours(room).items():
+            for door in doors:
+                (x1, y1, s1), (x2, y2, s2) = self.world.doors.squares_for(*door)
+                z = door[4]
+                if self.world.rooms.get(x1, y1, z) is room:
+                    near, far = (x1, y1, z), (x2, y2, z)
+                else:
+                    near, far = (x2, y2, z), (x1, y1, z)
+                result.append((near, far if other is not None else None))
+        return result
+    
+    
+    def find_path(self, start, goal):
+        """
+        Returns the list of (x, y, z) squares from start to goal inclusive,
+        or None if there's no way through.
+        """
+        rooms = self.world.rooms
+        start_room = rooms.get(*start)
+        goal_room = rooms.get(*goal)
+        if start_room is None or goal_room is None:
+            return None
+        gx, gy = goal[0], goal[1]
+        # A* over the abstract graph. Heap entries are (estimated total,
+        # cost before this edge, node, the node it came from, edge); edge
+        # is (cost, path) once known, or None if it's still an estimate.
+        # Closed nodes map to (node they came from, path of the edge), and
+        # best holds the cheapest known (real, not estimated) cost to each.
+        closed = {}
+        best = {start: 0}
+        heap = [(octile(start[0], start[1], gx, gy), 0, start, None, (0, None))]
+        while heap:
+            f, before, node, parent, edge = heapq.heappop(heap)
+            if node in closed:
+                continue
+            if edge is None:
+                # Find out what the leg really costs, and put it back
+                edge = self._leg(rooms.get(*parent), parent, node, cache=parent != start and node != goal)
+                if edge is not None and before + edge[0] < best.get(node, before + edge[0] + 1):
+                    best[node] = before + edge[0]
+                    heapq.heappush(heap, (before + edge[0] + octile(node[0], node[1], gx, gy), before, node, parent, edge))
+                continue
+            closed[node] = (parent, edge[1])
+            if node == goal:
+                return self._refine(node, closed)
+            cost = before + edge[0]
+            room = rooms.get(*node)
+            steps = []
+            # Across the room to each of its doors, or to the goal...
+            entrances = self.entrances(room)
+            for near, far in entrances:
+                steps.append((near, octile(node[0], node[1], near[0], near[1]), None))
+            if room is goal_room:
+                steps.append((goal, octile(node[0], node[1], gx, gy), None))
+            # ...and through the door, if this is a door square
+            for near, far in entrances:
+                if near == node and far is not None:
+                    steps.append((far, STRAIGHT_COST, (STRAIGHT_COST, None)))
+            for target, step, edge in steps:
+                # An estimate can't beat a real cost it's already no better than
+                if target in closed or cost + step >= best.get(target, cost + step + 1):
+                    continue
+                if edge is not None:
+                    best[target] = cost + step
+                heapq.heappush(heap, (cost + step + octile(target[0], target[1], gx, gy), cost, target, node, edge))
+        return None
+    
+    
+    def _refine(self, node, closed):
+        "Turns the chain of abstract nodes into a full path of squares."
+        legs = []
+        while node is not None:
+            parent, path = closed[node]
+            legs.append((node, path))
+            node = parent
+        legs.reverse()
+        path = [legs[0][0]]
+        for node, leg in legs[1:]:
+            if leg is None:
+                # Straight through a door
+                path.append(node)
+            else:
+                path.extend(leg[1:])
+        return path
+
+
+
+class PathCache(object):
+    
+    """
+    An LRU cache of routes in front of one or more path finders, keyed by
+    (start, goal, agent class). Each agent class can have its own finder;
+    anything without one uses the default.
+    
+    Each cached route remembers the generation of every chunk it passes
+    through (see World.chunk_generation). A route is only thrown away when
+    one of those chunks has changed since, so building in one corner of
+    the airport leaves routes elsewhere alone. Failed searches aren't
+    cached, as they depend on the whole world.
+    """
+    
+    def __init__(self, world, finder, size=4096):
+        self.world = world
+        self.finders = {None: finder}
+        self.size = size
+        self._routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    
+    def set_finder(self, agent_class, finder):
+        "Uses finder for agent_class's routes."
+        self.finders[agent_class] = finder
+        self.invalidate_class(agent_class)
+    
+    
+    def invalidate_class(self, agent_class):
+        "Drops every cached route for agent_class."
+        for key in [key for key in self._routes if key[2] == agent_class]:
+            del self._routes[key]
+    
+    
+    def _chunks_for(self, path):
+        "Returns the set of (cx, cy, z) chunks a path depends on."
+        shift = ChunkGrid.SHIFT
+        chunks = set()
+        for (x, y, z), (x2, y2, z2) in zip(path, path[1:] or path):
+            chunks.add((x >> shift, y >> shift, z))
+            chunks.add((x2 >> shift, y2 >> shift, z))
+            if x != x2 and y != y2:
+                # Diagonal steps also depend on the squares cut past
+                chunks.add((x2 >> shift, y >> shift, z))
+                chunks.add((x >> shift, y2 >> shift, z))
+        return chunks
+    
+    
+    def find_path(self, start, goal, agent_class=None):
+        "Returns a (possibly cached) path from start to goal, or None."
+        key = (start, goal, agent_class)
+        generation = self.world.chunk_generation
+        route = self._routes.pop(key, None)
+        if route is not None:
+            path, stamps = route
+            if all(generation(*chunk) == stamp for chunk, stamp in stamps):
+                # Still good; put it back as the most recently used
+                self._routes[key] = route
+                self.hits += 1
+                return path
+        self.misses += 1
+        finder = self.finders.get(agent_class, self.finders[None])
+        path = finder.find_path(start, goal)
+        if path is not None:
+            stamps = tuple((chunk, generation(*chunk)) for chunk in self._chunks_for(path))
+            self._routes[key] = (path, stamps)
+            while len(self._routes) > self.size:
+                self._routes.popitem(last=False)
+        return path
@@ -0,0 +1,109 @@
+
+class QuadTree(object):
+
+    """
+    A region quadtree over integer points, used to find which points lie in
+    a rectangle without looking at all of them. Each node covers a square
+    whose side is a power of two, and counts the points beneath it; empty
+    nodes are pruned. The root doubles in size whenever a point is inserted
+    outside it, so there are no fixed bounds.
+
+    Nodes are lists of [x, y, size, count, children], where children is a
+    list of four nodes (or None) ordered by quadrant, or None for a leaf.
+    """
+
+    X, Y, SIZE, COUNT, CHILDREN = range(5)
+
+    def __init__(self):
+        self.root = None
+
+
+    def __len__(self):
+        if self.root is None:
+            return 0
+        return self.root[self.COUNT]
+
+
+    def _covers(self, node, x, y):
+        return node[0] <= x < node[0] + node[2] and node[1] <= y < node[1] + node[2]
+
+
+    def _quadrant(self, node, x, y):
+        half = node[2] >> 1
+        return (x >= node[0] + half) + 2 * (y >= node[1] + half)
+
+
+    def insert(self, x, y):
+        "Adds the point x, y. Inserting a point twice is an error."
+        if self.root is None:
+            self.root = [x, y, 1, 0, None]
+        # Grow the root until it covers the new point
+        while not self._covers(self.root, x, y):
+            ox, oy, size = self.root[:3]
+            if x < ox:
+                ox -= size
+            if y < oy:
+                oy -= size
+            children = [None] * 4
+            children[(self.root[0] != ox) + 2 * (self.root[1] != oy)] = self.root
+            self.root = [ox, oy, size * 2, self.root[self.COUNT], children]
+        # Walk down, creating nodes as needed, and only count the point
+        # once we know it's not already there
+        path = [self.root]
+        while path[-1][2] > 1:
+            node = path[-1]
+            quadrant = self._quadrant(node, x, y)
+            child = node[4][quadrant]
+            if child is None:
+                half = node[2] >> 1
+                child = [
+                    node[0] + half * (quadrant & 1),
+                    node[1] + half * (quadrant >> 1),
+                    half,
+                    0,
+                    [None] * 4 if half > 1 else None,
+                ]
+                node[4][quadrant] = child
+            path.append(child)
+        if path[-1][3]:
+            raise ValueError("Point (%s, %s) is already in the QuadTree." % (x, y))
+        for node in path:
+            node[3] += 1
+
+
+    def remove(self, x, y):
+        "Removes the point x, y, pruning any nodes left empty."
+        if self.root is None or not self._covers(self.root, x, y):
+            raise KeyError((x, y))
+        # Find the path down to the point first, so a miss changes nothing
+        path = [self.root]
+        while path[-1][2] > 1:
+            child = path[-1][4][self._quadrant(path[-1], x, y)]
+            if child is None:
+                raise KeyError((x, y))
+            path.append(child)
+        for node in path:
+            node[3] -= 1
+        # Prune empty nodes from the bottom up
+        for parent, node in reversed(zip(path, path[1:])):
+            if node[3]:
+                break
+            parent[4][self._quadrant(parent, x, y)] = None
+        if not self.root[3]:
+            self.root = None
+
+
+    def query(self, x1, y1, x2, y2):
+        "Yields (x, y) for every point with x1 <= x < x2 and y1 <= y < y2."
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nx, ny, size = node[:3]
+            if nx >= x2 or ny >= y2 or nx + size <= x1 or ny + size <= y1:
+                continue
+            if size == 1:
+                yield nx, ny
+            else:
+                stack.extend(child for child in node[4] if child is not None)
@@ -16,4 +16,10 @@ class Room(object):
     def from_coords(cls, world, type, coords):
         instance = cls(world, type)
         world.add_room(instance, coords)
+        return instance
+    
+    @classmethod
+    def from_rect(cls, world, type, x1, y1, x2, y2, z):
+        instance = cls(world, type)
+        world.add_room_rect(instance, x1, y1, x2, y2, z)
         return instance
\ No newline at end of file
@@ -0,0 +1,124 @@
+
+import heapq
+
+
+class PointIndex(object):
+
+    """
+    A bucketed spatial index of keyed points, for nearest-neighbour and
+    within-radius queries. Each z-level is a dict of square buckets
+    (BUCKET x BUCKET units) holding {key: (x, y)}; a nearest query searches
+    outwards one ring of buckets at a time, and stops as soon as nothing in
+    the next ring could beat what it's already found.
+
+    Points can be added and removed at any time, in O(1).
+    """
+
+    BUCKET = 16
+
+    def __init__(self):
+        self._levels = {}
+        self._bounds = {}
+        self._points = {}
+
+
+    def __len__(self):
+        return len(self._points)
+
+
+    def __contains__(self, key):
+        return key in self._points
+
+
+    def add(self, key, x, y, z):
+        "Adds a point under key (which must not already be present)."
+        if key in self._points:
+            raise ValueError("Key %r is already in the PointIndex." % (key,))
+        bx, by = int(x // self.BUCKET), int(y // self.BUCKET)
+        self._levels.setdefault(z, {}).setdefault((bx, by), {})[key] = (x, y)
+        self._points[key] = (x, y, z)
+        # The bounds only ever grow while the level has points; they're
+        # just there to tell a nearest search when to give up.
+        bounds = self._bounds.get(z)
+        if bounds is None:
+            self._bounds[z] = [bx, by, bx, by]
+        else:
+            bounds[:] = [min(bounds[0], bx), min(bounds[1], by), max(bounds[2], bx), max(bounds[3], by)]
+
+
+    def remove(self, key):
+        "Removes the point stored under key."
+        x, y, z = self._points.pop(key)
+        level = self._levels[z]
+        bucket_key = (int(x // self.BUCKET), int(y // self.BUCKET))
+        bucket = level[bucket_key]
+        del bucket[key]
+        if not bucket:
+            del level[bucket_key]
+            if not level:
+                del self._levels[z]
+                del self._bounds[z]
+
+
+    def _ring(self, level, bx, by, d):
+        "Yields the non-empty buckets at Chebyshev distance d from (bx, by)."
+        if d == 0:
+            if (bx, by) in level:
+                yield level[bx, by]
+            return
+        for ix in range(bx - d, bx + d + 1):
+            for iy in (by - d, by + d):
+                if (ix, iy) in level:
+                    yield level[ix, iy]
+        for iy in range(by - d + 1, by + d):
+            for ix in (bx - d, bx + d):
+                if (ix, iy) in level:
+                    yield level[ix, iy]
+
+
+    def nearest(self, x, y, z, k=1, max_distance=None):
+        """
+        Returns up to k (distance, key) pairs for the points on level z
+        nearest to (x, y), closest first.
+        """
+        level = self._levels.get(z)
+        if not level or k < 1:
+            return []
+        bx, by = int(x // self.BUCKET), int(y // self.BUCKET)
+        minx, miny, maxx, maxy = self._bounds[z]
+        furthest = max(bx - minx, maxx - bx, by - miny, maxy - by)
+        # Max-heap (by negated distance) of the best k found so far
+        best = []
+        for d in range(furthest + 1):
+            for bucket in self._ring(level, bx, by, d):
+                for key, (px, py) in bucket.items():
+                    distance = ((px - x) ** 2 + (py - y) ** 2) ** 0.5
+                    if max_distance is not None and distance > max_distance:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, key))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, key))
+            # Anything in further rings is at least this far away
+            reach = d * self.BUCKET
+            if len(best) == k and -best[0][0] <= reach:
+                break
+            if max_distance is not None and reach > max_distance:
+                break
+        return sorted((-distance, key) for distance, key in best)
+
+
+    def within(self, x, y, z, r):
+        "Returns (distance, key) pairs for points within r of (x, y), closest first."
+        level = self._levels.get(z)
+        if not level:
+            return []
+        found = []
+        for bx in range(int((x - r) // self.BUCKET), int((x + r) // self.BUCKET) + 1):
+            for by in range(int((y - r) // self.BUCKET), int((y + r) // self.BUCKET) + 1):
+                for key, (px, py) in level.get((bx, by), {}).items():
+                    distance = ((px - x) ** 2 + (py - y) ** 2) ** 0.5
+                    if distance <= r:
+                        found.append((distance, key))
+        found.sort()
+        return found